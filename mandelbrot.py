@@ -1,15 +1,35 @@
+"""Explore the Mandelbrot set, recording 1080x1920 video with R.
+
+    python mandelbrot.py                          # interactive
+    python mandelbrot.py --offline 60             # render 60 s of frames as PNGs
+    python mandelbrot.py --offline 60 --output - | ffmpeg -f rawvideo \\
+        -pix_fmt rgba -s 1080x1920 -r 60 -i - -vf vflip out.mp4
+"""
+import argparse
 import math
+import sys
 from pathlib import Path
 
 import pyglet
+
+parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument('--offline', type=float, metavar='SECONDS', help="render and record this long a clip without a window, as fast as possible")
+parser.add_argument('--output', help="with --offline, write raw RGBA frames to this file ('-' for stdout) instead of PNGs")
+args = parser.parse_args()
+if args.offline is not None:
+    # Must be set before pyglet.gl is imported.
+    pyglet.options['headless'] = True
+
 from pyglet.math import Vec2
 from pyglet.gl import glViewport
 
 import refs_gl
-from refs import computed, Active, Reducer
+from refs import computed, Active, Reducer, Ref
+
+FPS = 60
 
 def setup(ctx):
-    time = refs_gl.video_time(ctx, fps=60)
+    time = refs_gl.video_time(ctx, fps=FPS)
     ctx = ctx.add({refs_gl.FrameTime: time})
     fractal_time = refs_gl.time_control(ctx)
     # fractal_time.log = 'fract'
@@ -24,24 +44,37 @@ def setup(ctx):
         glViewport(0, 0, 1080, 1920)
     ctx[refs_gl.Draws].add(ctx[Active], bind)
 
-    refs_gl.draw_shader_image(ctx,
-        Path("shaders/mandelbrot.glsl").read_text(),
-        uniforms={
-            'resolution': (1080, 1920),
-            'offset': view.center,
-            'zoom': view.zoom,
-            # 'time': ctx[refs_gl.FrameTime],
-            'time': fractal_time,
-        },
-    )
+    if args.offline is not None:
+        recording = Ref(True)
+    else:
+        recording = Reducer(False)
+        @recording.reduce(ctx[refs_gl.KeyPress])
+        def _(prev, key):
+            if key != 'R':
+                return prev
+            return not prev
+    shader = Path("shaders/mandelbrot.glsl").read_text()
+    uniforms = {
+        'resolution': (1080, 1920),
+        'offset': view.center,
+        'zoom': view.zoom,
+        # 'time': ctx[refs_gl.FrameTime],
+        'time': fractal_time,
+    }
+    # Recordings need every frame complete.
+    refs_gl.draw_shader_image(ctx.add({Active: recording}), shader, uniforms=uniforms)
+    if args.offline is None:
+        # Otherwise keep panning and zooming responsive.
+        not_recording = computed([recording])(lambda recording: not recording)
+        refs_gl.draw_shader_image(ctx.add({Active: not_recording}), shader,
+            uniforms=uniforms, progressive=['offset', 'zoom'])
+
     def save_screen():
         pass
-    is_saving = Ref(False)
-    @ctx[refs_gl.KeyMap]['S'].watch()
-    def toggle_saving(s):
-        if s:
-            # .map could remove the dependency here, if this were a multi-watch...
-            is_saving.set(not is_saving())
+    is_saving = Reducer(False)
+    @is_saving.reduce(ctx[refs_gl.KeyPress])
+    def _(prev, key):
+        return not prev if key == 'S' else prev
     ctx[refs_gl.Draws].add(is_saving, save_screen)
 
     def draw_fb():
@@ -52,13 +85,16 @@ def setup(ctx):
         tex.blit(0, 0, width=w, height=h)
     ctx[refs_gl.Draws].add(ctx[Active], draw_fb)
 
-    recording = Reducer(False)
-    @recording.reduce(ctx[refs_gl.KeyPress])
-    def _(prev, key):
-        if key != 'R':
-            return prev
-        return not prev
-    refs_gl.record_image(ctx.add({Active: recording}), tex)
+    output = args.output
+    if output == '-':
+        output = sys.stdout.buffer
+        # Keep anything printed out of the frames.
+        sys.stdout = sys.stderr
+    return refs_gl.record_image(ctx.add({Active: recording}), tex, output=output)
 
-refs_gl.define_window(setup, 480, 854)
-pyglet.app.run()
+if args.offline is not None:
+    # Closes the recorder before the window.
+    refs_gl.define_window(setup, 480, 854, frames=round(args.offline * FPS), fps=FPS)
+else:
+    refs_gl.define_window(setup, 480, 854)
+    pyglet.app.run()
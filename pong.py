@@ -20,7 +20,7 @@ class sample_reduce(ReadableReactive):
     def __init__(self, reduce, time, state):
         self._reduce = reduce
         self._time = time
-        self._time.links.add(self)
+        self._time.link(self)
         self._state = state
         super().__init__(self._reduce(0.0, self._state), is_event=False)
     def update(self):
@@ -1,5 +1,8 @@
 import ctypes
+import hashlib
+import weakref
 from array import array
+from collections import OrderedDict
 from dataclasses import dataclass
 from time import time
 
@@ -7,26 +10,134 @@ import pyglet
 import pyglet.math as pm
 import reactivex
 from pyglet.graphics.vertexbuffer import BufferObject
-from pyglet.graphics.shader import Shader, ShaderProgram
 from pyglet.gl import *
 
+from shader_cache import load_program
+
 def array_sizeof(a):
     return a.buffer_info()[1] * a.itemsize
 
 def array_ptr(a):
     return a.buffer_info()[0]
 
-_keys = dict()
+def content_key(*parts):
+    """Return a key identifying the given strings and bytes-like objects by
+    their content."""
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        h.update(len(part).to_bytes(8, 'little'))
+        h.update(part)
+    return h.digest()
+
+class ResourceCache:
+    """Least-recently-used cache of GL resources.
+
+    When there are more than max_entries, or their sizes add up to more than
+    max_bytes, the least recently used are evicted and their GL objects
+    deleted. Values created while creating another (like a VAO's buffer) are
+    counted as used whenever it is, so they outlive it. Pinned values are
+    never evicted.
+    """
+    def __init__(self, *, max_entries=4096, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # key -> [value, size, keys of values used to create it]
+        self._entries = OrderedDict()
+        # Sets of keys used by the values being created.
+        self._creating = []
+        # key -> number of pins
+        self._pinned = {}
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    def get(self, key, new):
+        if self._creating:
+            self._creating[-1].add(key)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._touch(key)
+            return entry[0]
+        self.misses += 1
+        self._creating.append(set())
+        try:
+            value = new()
+        finally:
+            used = self._creating.pop()
+        size = getattr(value, 'size', 0)
+        self._entries[key] = [value, size, used]
+        self._touch(key)
+        self.bytes += size
+        self._evict()
+        return value
+    def _touch(self, key):
+        entry = self._entries.get(key)
+        if entry is None: return
+        self._entries.move_to_end(key)
+        for k in entry[2]:
+            self._touch(k)
+    def _evict(self):
+        # Always keep the most recent, even if it's over budget alone.
+        while len(self._entries) - len(self._pinned) > 1 and (len(self._entries) > self.max_entries or self.bytes > self.max_bytes):
+            key = next(k for k in self._entries if k not in self._pinned)
+            self.discard(key)
+            self.evictions += 1
+    def pin(self, key):
+        """Keep key's value from being evicted until it's unpinned as many times."""
+        self._pinned[key] = self._pinned.get(key, 0) + 1
+    def unpin(self, key):
+        count = self._pinned.get(key)
+        if count is None: return
+        if count == 1:
+            # Evicted the next time the cache is used, rather than wherever
+            # this is called from (like the garbage collector).
+            del self._pinned[key]
+        else:
+            self._pinned[key] = count - 1
+    def resized(self, key, size):
+        """Record that key's value now takes size bytes."""
+        entry = self._entries[key]
+        self.bytes += size - entry[1]
+        entry[1] = size
+        self._evict()
+    def discard(self, key):
+        """Remove key, deleting its GL object."""
+        entry = self._entries.pop(key, None)
+        if entry is None: return
+        self._pinned.pop(key, None)
+        value, size, _ = entry
+        self.bytes -= size
+        delete = getattr(value, 'delete', None)
+        if delete is not None:
+            delete()
+    def clear(self):
+        for key in list(self._entries):
+            self.discard(key)
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+cache = ResourceCache()
 _provided = dict()
 
 def use_memo(f, *, key=None):
-    if key is None: key = id(f)
-    if key in _keys:
-        return _keys[key]
-    print("new key")
-    x = f()
-    _keys[key] = x
-    return x
+    # By default, f is called once per place it's defined and values of the
+    # variables it closes over, so closures made in a loop don't share one.
+    if key is None:
+        key = (f.__code__, *(cell.cell_contents for cell in f.__closure__ or ()))
+        try:
+            hash(key)
+        except TypeError:
+            raise TypeError("the variables f closes over aren't hashable; pass a key") from None
+    return cache.get(key, f)
 
 def use_once(f, *, key=None):
     return use_memo(f, key=key)
@@ -34,28 +145,112 @@ def use_once(f, *, key=None):
 def obtain(name):
     return _provided.get(name)
 
+def _program_key(stages):
+    return content_key(*sorted(stages.values()))
+
 def use_program(**stages):
     def new():
-        shaders = [
-            use_once(lambda: Shader(src, stage), key=src)
-            for stage, src in stages.items()
-        ]
-        print(stages)
-        return ShaderProgram(*shaders)
-    return use_once(new, key=frozenset(stages.values()))
-
-def use_array_buffer(data, *, key=None):
-    if key is None: key = id(data)
-    arr = array('f', data)
-    buffer = use_once(lambda: BufferObject(array_sizeof(arr)), key=key)
-    buffer.set_data(arr.tobytes())
+        # Loaded from the on-disk binary cache when the driver has seen it.
+        return load_program(**stages)
+    return use_once(new, key=_program_key(stages))
+
+def _contents(data, typecode):
+    # Return data's bytes as a memoryview and something to pass to GL for
+    # them, copying only if it isn't already contiguous typecode items.
+    try:
+        view = memoryview(data)
+    except TypeError:
+        view = memoryview(array(typecode, data))
+    if view.format != typecode or not view.c_contiguous:
+        if hasattr(data, 'astype'):
+            # NumPy. Unlike array(), astype wraps values which don't fit.
+            import numpy
+            dtype = numpy.dtype(typecode)
+            if dtype.kind in 'iu' and data.size:
+                limits = numpy.iinfo(dtype)
+                if data.min() < limits.min or data.max() > limits.max:
+                    raise OverflowError(f"values don't fit in typecode {typecode!r}; pass a bigger one, e.g. typecode='I'")
+            view = memoryview(data.astype(typecode, order='C'))
+        else:
+            view = memoryview(array(typecode, view.tolist()))
+    view = view.cast('B')
+    if view.readonly:
+        return view, view.tobytes()
+    return view, (GLubyte * len(view)).from_buffer(view)
+
+def _use_buffer(data, typecode, key, version, dirty, stream):
+    view, pointer = _contents(data, typecode)
+    size = len(view)
+    # Without a key, the buffer is identified by its content, so it only needs
+    # filling when created.
+    if key is None:
+        def new():
+            buffer = BufferObject(size, GL_STATIC_DRAW)
+            buffer.set_data(pointer)
+            return buffer
+        return use_once(new, key=content_key(typecode, view))
+    buffer = use_once(lambda: BufferObject(size, GL_STREAM_DRAW if stream else GL_DYNAMIC_DRAW), key=key)
+    if stream:
+        # Orphan the old storage so the GPU can keep reading from it while
+        # this is written to new storage.
+        if buffer.size != size:
+            buffer.size = size
+            cache.resized(key, size)
+        buffer.bind()
+        buffer.invalidate()
+        buffer.set_data_region(pointer, 0, size)
+        return buffer
+    # What was last uploaded, as a version or a hash.
+    content = version if version is not None else content_key(view)
+    if buffer.size == size and getattr(buffer, 'content', None) == content:
+        return buffer
+    if buffer.size != size:
+        buffer.size = size
+        cache.resized(key, size)
+        dirty = None
+    if getattr(buffer, 'content', None) is None:
+        # New, so nothing has been uploaded for dirty to be relative to.
+        dirty = None
+    if dirty is None:
+        buffer.set_data(pointer)
+    else:
+        itemsize = array(typecode).itemsize
+        for start, stop in dirty:
+            start *= itemsize
+            length = stop * itemsize - start
+            if view.readonly:
+                region = pointer[start:start + length]
+            else:
+                region = (GLubyte * length).from_buffer(view, start)
+            buffer.set_data_region(region, start, length)
+    buffer.content = content
     return buffer
 
-def use_element_buffer(data, *, key=None):
-    if key is None: key = id(data)
-    arr = array('H', data)
-    buffer = use_once(lambda: BufferObject(array_sizeof(arr)), key=key)
-    buffer.set_data(arr.tobytes())
+def use_array_buffer(data, *, key=None, version=None, dirty=None, stream=False):
+    """Return a buffer holding data as floats.
+
+    data can be any iterable, but NumPy float32 arrays and other contiguous
+    buffers of floats aren't copied. Without a key, there's a buffer for each
+    distinct content. With one, the buffer is reused and refilled only when
+    data changes: when version changes, if given, otherwise when its hash
+    does. dirty is a list of (start, stop) element ranges to upload instead
+    of the whole. For data which changes every frame, stream skips the check
+    and gives the buffer new storage each time, so drawing needn't wait for
+    the GPU to finish with the old data.
+    """
+    return _use_buffer(data, 'f', key, version, dirty, stream)
+
+# Element buffer typecode -> GL index type.
+_index_types = {
+    'H': GL_UNSIGNED_SHORT,
+    'I': GL_UNSIGNED_INT,
+}
+
+def use_element_buffer(data, *, key=None, version=None, dirty=None, stream=False, typecode='H'):
+    """Like use_array_buffer, for indices. They are unsigned shorts, or with
+    typecode='I', unsigned 32-bit ints for meshes of over 65536 vertices."""
+    buffer = _use_buffer(data, typecode, key, version, dirty, stream)
+    buffer.index_type = _index_types[typecode]
     return buffer
 
 @dataclass
@@ -63,50 +258,149 @@ class VAO():
     id: int
     spec: list
     buffer: BufferObject
+    instance_buffer: BufferObject = None
+    def delete(self):
+        glDeleteVertexArrays(1, self.id)
+
+def _glsl_type(n):
+    return 'float' if n == 1 else 'mat4' if n == 16 else f'vec{n}'
 
-def new_attributes(spec, buf):
+def _set_attributes(spec, buf, location, divisor):
+    # Point attributes from location onwards at interleaved floats in buf.
+    # Returns the next free location.
     buf.bind(GL_ARRAY_BUFFER)
+    stride = sum(s[1] for s in spec)
+    offset = 0
+    for name, vlen in spec:
+        # A mat4 is given as four vec4 columns, each at its own location.
+        for _ in range(4 if vlen == 16 else 1):
+            size = 4 if vlen == 16 else vlen
+            glVertexAttribPointer(location, size, GL_FLOAT, False, stride * ctypes.sizeof(GLfloat), offset * ctypes.sizeof(GLfloat))
+            glEnableVertexAttribArray(location)
+            if divisor:
+                glVertexAttribDivisor(location, divisor)
+            location += 1
+            offset += size
+    return location
+
+def new_attributes(spec, buf, *, instanced=None):
+    """Return a VAO reading attributes (name, length) from buf.
+
+    instanced is an optional (spec, buffer) of attributes which advance per
+    instance instead of per vertex. A length of 16 is a mat4, stored column
+    by column like pyglet.math.Mat4.
+    """
     vao = GLuint()
     glGenVertexArrays(1, vao)
     glBindVertexArray(vao)
-    stride = sum(s[1] for s in spec)
-    offset = 0
-    for i, (name, vlen) in enumerate(spec):
-        glVertexAttribPointer(i, vlen, GL_FLOAT, False, stride * ctypes.sizeof(GLfloat), offset * ctypes.sizeof(GLfloat))
-        glEnableVertexAttribArray(i)
-        offset += vlen
-    return VAO(id=vao, spec=spec, buffer=buf)
+    location = _set_attributes(spec, buf, 0, 0)
+    if instanced is None:
+        return VAO(id=vao, spec=spec, buffer=buf)
+    instance_spec, instance_buffer = instanced
+    _set_attributes(instance_spec, instance_buffer, location, 1)
+    return VAO(id=vao, spec=[*spec, *instance_spec], buffer=buf, instance_buffer=instance_buffer)
 
 _uniform_types = {
     float: "float",
     pm.Mat4: "mat4",
 }
 
-def set_state(*, attributes, vertex_shader, fragment_shader, passthrough=[], uniforms={}):
-    attr_lengths = dict(attributes.spec)
-    uniform_header = [f"uniform {_uniform_types[type(value)]} {name};" for name, value in uniforms.items()]
+def _stage_sources(spec, vertex_shader, fragment_shader, passthrough, uniform_types):
+    attr_types = {name: _glsl_type(n) for name, n in spec}
+    uniform_header = [f"uniform {glsl_type} {name};" for name, glsl_type in uniform_types.items()]
+    inputs = []
+    assemble = []
+    loc = 0
+    for name, n in spec:
+        if n == 16:
+            # pyglet can't introspect mat4 inputs, so take the columns and
+            # assemble them.
+            columns = [f"{name}_{i}" for i in range(4)]
+            inputs += [f"layout(location={loc + i}) in vec4 {column};" for i, column in enumerate(columns)]
+            inputs.append(f"mat4 {name};")
+            assemble.append(f"{name} = mat4({', '.join(columns)});")
+            loc += 4
+        else:
+            inputs.append(f"layout(location={loc}) in {attr_types[name]} {name};")
+            loc += 1
     vertex_src = "\n".join([
         "#version 330 core",
         *uniform_header,
-        *[f"layout(location={loc}) in vec{n} {name};" for loc, (name, n) in enumerate(attributes.spec)],
-        *[f"out vec{attr_lengths[name]} attr_{name};" for name in passthrough],
+        *inputs,
+        *[f"out {attr_types[name]} attr_{name};" for name in passthrough],
         vertex_shader,
-        "void main() { doStage();",
+        "void main() {",
+        *assemble,
+        "doStage();",
         *[f"attr_{name} = {name};" for name in passthrough],
         "}",
     ])
     fragment_src = "\n".join([
         "#version 330 core",
         *uniform_header,
-        *[f"in vec{attr_lengths[name]} attr_{name};" for name in passthrough],
+        *[f"in {attr_types[name]} attr_{name};" for name in passthrough],
         fragment_shader,
         "void main() { doStage(); }",
     ])
+    return vertex_src, fragment_src
+
+def set_state(*, attributes, vertex_shader, fragment_shader, passthrough=[], uniforms={}):
+    vertex_src, fragment_src = _stage_sources(attributes.spec, vertex_shader, fragment_shader, passthrough,
+        {name: _uniform_types[type(value)] for name, value in uniforms.items()})
     program = use_program(vertex=vertex_src, fragment=fragment_src)
     for name, value in uniforms.items():
         program[name] = value
+    values = _uniform_values.get(program)
+    if values is not None:
+        values.update(uniforms)
     program.use()
 
+# GLSL type -> function returning a setter for a uniform at a location.
+_uniform_setters = {
+    'float': lambda location: lambda x: glUniform1f(location, x),
+    'mat4': lambda location: lambda m: glUniformMatrix4fv(location, 1, GL_FALSE, (GLfloat * 16)(*m)),
+}
+
+# program -> {uniform name: last value set}
+_uniform_values = weakref.WeakKeyDictionary()
+
+class Pipeline:
+    """What set_state sets up, compiled once.
+
+    uniforms maps names to types, either Python types like in set_state, or
+    GLSL type names. Then use() does what set_state does for the same
+    arguments, but only uploads uniforms whose values have changed.
+    """
+    def __init__(self, *, spec, vertex_shader, fragment_shader, passthrough=[], uniforms={}):
+        types = {name: _uniform_types.get(t, t) for name, t in uniforms.items()}
+        vertex_src, fragment_src = _stage_sources(spec, vertex_shader, fragment_shader, passthrough, types)
+        self.program = use_program(vertex=vertex_src, fragment=fragment_src)
+        # Keep the program from being evicted and deleted while this can use it.
+        key = _program_key({'vertex': vertex_src, 'fragment': fragment_src})
+        cache.pin(key)
+        weakref.finalize(self, cache.unpin, key)
+        self._setters = {}
+        for name, glsl_type in types.items():
+            info = self.program.uniforms.get(name)
+            # The compiler may have removed it if it's unused.
+            if info is not None:
+                self._setters[name] = _uniform_setters[glsl_type](info['location'])
+        # Pipelines with the same source share a program and so uniform values.
+        self._values = _uniform_values.setdefault(self.program, {})
+    def use(self, attributes=None, **uniforms):
+        self.program.use()
+        if attributes is not None:
+            glBindVertexArray(attributes.id)
+        self._upload(uniforms)
+    def _upload(self, uniforms):
+        values = self._values
+        for name, value in uniforms.items():
+            if values.get(name, values) != value:
+                setter = self._setters.get(name)
+                if setter is not None:
+                    setter(value)
+                values[name] = value
+
 def clear_window():
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
 
@@ -114,11 +408,59 @@ _modes = {
     'triangles': GL_TRIANGLES,
 }
 
-def draw_elements(ebuf, mode, count=None, offset=0):
+# GL index type -> size in bytes.
+_index_sizes = {
+    GL_UNSIGNED_SHORT: ctypes.sizeof(GLushort),
+    GL_UNSIGNED_INT: ctypes.sizeof(GLuint),
+}
+
+def _draw(ebuf, mode, count, offset, instances):
+    index_type = getattr(ebuf, 'index_type', GL_UNSIGNED_SHORT)
     if count is None:
-        count = ebuf.size // ctypes.sizeof(GLushort)
+        count = ebuf.size // _index_sizes[index_type]
+    if instances == 1:
+        glDrawElements(_modes[mode], count, index_type, offset)
+    else:
+        glDrawElementsInstanced(_modes[mode], count, index_type, offset, instances)
+
+def draw_elements(ebuf, mode, count=None, offset=0, instances=1):
     ebuf.bind(GL_ELEMENT_ARRAY_BUFFER)
-    glDrawElements(_modes[mode], count, GL_UNSIGNED_SHORT, offset)
+    _draw(ebuf, mode, count, offset, instances)
+
+def _batch_order(draw):
+    return id(draw[0]), draw[1].id.value
+
+class Batch:
+    """Draws collected over a frame and submitted together.
+
+    draw() sorts them by pipeline and then VAO, so each is bound once, and
+    each pipeline only uploads uniforms which differ from its previous draw.
+    Many copies of a mesh are best drawn as one instanced draw, with their
+    transforms in an instanced attribute (see new_attributes).
+    """
+    def __init__(self):
+        self._draws = []
+    def add(self, pipeline, attributes, elements, mode='triangles', *, count=None, instances=1, **uniforms):
+        self._draws.append((pipeline, attributes, elements, mode, count, instances, uniforms))
+    def draw(self):
+        self._draws.sort(key=_batch_order)
+        bound = attributes = elements = None
+        for pipeline, a, e, mode, count, instances, uniforms in self._draws:
+            if pipeline is not bound:
+                pipeline.use(**uniforms)
+                bound = pipeline
+            else:
+                pipeline._upload(uniforms)
+            if a is not attributes:
+                glBindVertexArray(a.id)
+                attributes = a
+                elements = None
+            if e is not elements:
+                e.bind(GL_ELEMENT_ARRAY_BUFFER)
+                elements = e
+            _draw(e, mode, count, 0, instances)
+    def clear(self):
+        self._draws.clear()
 
 def run_window(f):
     draws = reactivex.Subject()
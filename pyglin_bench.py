@@ -0,0 +1,134 @@
+"""Frame-time benchmark of pyglin's set_state against Pipeline and Batch.
+
+Draws n small meshes per frame into a hidden window, each with its own
+transform: setting state with set_state, then with a Pipeline, and then as
+one instanced draw from a Batch:
+
+    python pyglin_bench.py
+    python pyglin_bench.py -n 10 100 1000 -f 200
+    python pyglin_bench.py --headless         # no display needed
+"""
+import argparse
+import statistics
+import sys
+from time import perf_counter
+
+import pyglet
+if '--headless' in sys.argv:
+    # Must be set before pyglet.gl is imported.
+    pyglet.options['headless'] = True
+
+import pyglet.math as pm
+import pyglin as pl
+from pyglet.gl import glFinish
+
+vertex_shader = """
+    void doStage() {
+        gl_Position = proj * model * vec4(pos, 1.0);
+    }
+"""
+fragment_shader = """
+    out vec4 outColor;
+    void doStage() {
+        outColor = vec4(attr_pos * 0.5 + 0.5, 1.0);
+    }
+"""
+
+def mesh():
+    attributes = pl.new_attributes(
+        [('pos', 3)],
+        pl.use_array_buffer([0.0, 0.0, 0.0, 0.1, 0.0, 0.0, 0.0, 0.1, 0.0], key='bench_triangle'),
+    )
+    elements = pl.use_element_buffer([0, 1, 2], key='bench_triangle_elements')
+    return attributes, elements
+
+def with_set_state(n, attributes, elements):
+    proj = pm.Mat4.orthogonal_projection(-1, 1, -1, 1, -1, 1)
+    def frame(t):
+        for i in range(n):
+            pl.set_state(
+                attributes=attributes,
+                vertex_shader=vertex_shader,
+                fragment_shader=fragment_shader,
+                passthrough={'pos'},
+                uniforms={'proj': proj, 'model': pm.Mat4.from_translation(pm.Vec3(i / n, t % 1, 0))},
+            )
+            pl.draw_elements(elements, 'triangles')
+    return frame
+
+def with_pipeline(n, attributes, elements):
+    proj = pm.Mat4.orthogonal_projection(-1, 1, -1, 1, -1, 1)
+    pipeline = pl.Pipeline(
+        spec=attributes.spec,
+        vertex_shader=vertex_shader,
+        fragment_shader=fragment_shader,
+        passthrough={'pos'},
+        uniforms={'proj': pm.Mat4, 'model': pm.Mat4},
+    )
+    def frame(t):
+        for i in range(n):
+            pipeline.use(attributes, proj=proj, model=pm.Mat4.from_translation(pm.Vec3(i / n, t % 1, 0)))
+            pl.draw_elements(elements, 'triangles')
+    return frame
+
+def with_instancing(n, attributes, elements):
+    # One instanced draw, with the transforms as a per-instance attribute.
+    import numpy
+    proj = pm.Mat4.orthogonal_projection(-1, 1, -1, 1, -1, 1)
+    models = numpy.tile(numpy.eye(4, dtype=numpy.float32).ravel(), (n, 1))
+    models[:, 12] = numpy.arange(n) / n
+    instance_buffer = pl.use_array_buffer(models, key=('bench_models', n), stream=True)
+    instanced = pl.new_attributes(attributes.spec, attributes.buffer, instanced=([('model', 16)], instance_buffer))
+    pipeline = pl.Pipeline(
+        spec=instanced.spec,
+        vertex_shader=vertex_shader,
+        fragment_shader=fragment_shader,
+        passthrough={'pos'},
+        uniforms={'proj': pm.Mat4},
+    )
+    batch = pl.Batch()
+    def frame(t):
+        models[:, 13] = t % 1
+        pl.use_array_buffer(models, key=('bench_models', n), stream=True)
+        batch.add(pipeline, instanced, elements, instances=n, proj=proj)
+        batch.draw()
+        batch.clear()
+    return frame
+
+paths = {
+    'set_state': with_set_state,
+    'Pipeline': with_pipeline,
+    'instanced': with_instancing,
+}
+
+def run(frame, frames):
+    times = []
+    for i in range(frames):
+        start = perf_counter()
+        pl.clear_window()
+        frame(i / 60)
+        glFinish()
+        times.append(perf_counter() - start)
+    return times
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('-f', '--frames', type=int, default=100)
+    parser.add_argument('--headless', action='store_true', help="use pyglet's headless mode")
+    args = parser.parse_args()
+    window = pyglet.window.Window(visible=False)
+    attributes, elements = mesh()
+    print(f"{'path':<12}{'draws':>8}{'p50 ms':>10}{'p95 ms':>10}")
+    for n in args.sizes:
+        for name, make in paths.items():
+            frame = make(n, attributes, elements)
+            # Warm up, e.g. compiling the program.
+            run(frame, 3)
+            times = sorted(run(frame, args.frames))
+            print(f"{name:<12}{n:>8}{statistics.median(times) * 1e3:>10.3f}"
+                f"{times[min(int(len(times) * 0.95), len(times) - 1)] * 1e3:>10.3f}")
+    window.close()
+
+if __name__ == '__main__':
+    main()
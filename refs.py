@@ -1,52 +1,279 @@
-_to_update = set()
+import heapq
+import json
+import threading
+from contextlib import contextmanager
+from functools import partial
+from itertools import count
+from numbers import Integral
+from operator import itemgetter
+from sys import _getframe
+from time import perf_counter
 
-def tick():
-    """Update all reactives based on changes to refs."""
-    topo_sort = []
-    loud_reachable = set(_to_update)
-    for seed in _to_update:
-        stack = [seed]
-        current_sort = []
-        enumerated = set()
-        # Where the inner sort will be inserted into the outer sort; the minimum index of all reactives
-        insert_point = 0
-        while len(stack):
-            r = stack.pop()
-            topo_i = insert_point
-            # Is the reactive already in the outer sort?
-            try:
-                topo_i = topo_sort.index(r)
-            except ValueError:
-                # No? Continue down tree, depth-first.
-                e = r in enumerated
-                if e or len(r.links) + len(r.quiet_links) == 0:
-                    if r not in current_sort: current_sort.append(r)
-                    if e: enumerated.remove(r)
+class Runtime:
+    """An independent reactive graph.
+
+    Every reactive belongs to the runtime of the first reactive it depends on,
+    or if it has none (like a Ref), the runtime which was current when it was
+    created. Only reactives in the same runtime can be linked. Each runtime
+    has its own set of changed refs and ticks separately, so graphs in different
+    runtimes can be ticked from different threads. A runtime itself must only
+    be used from one thread at a time.
+
+    If executor is given (e.g. a concurrent.futures.ThreadPoolExecutor),
+    ParallelComputeds in this runtime are evaluated on it during ticks.
+
+    If equal is given (e.g. `equal`), ticks cut off propagation early: when a
+    reactive's next value is equal to its current one, and it isn't an event
+    which occurred, its flags aren't set and its links aren't updated. This
+    evaluates Computeds eagerly in order to compare them. ParallelComputeds are
+    compared once the others of their rank have been submitted, so those still
+    run concurrently.
+
+    If profiler is given (a Profiler), ticks and updates are timed into it.
+
+    If lazy is true, Computeds in this runtime are lazy by default; see
+    Computed.
+    """
+    def __init__(self, *, executor=None, equal=None, profiler=None, lazy=False):
+        self.executor = executor
+        self.equal = equal
+        self.profiler = profiler
+        self.lazy = lazy
+        self._to_update = set()
+        self._batch_depth = 0
+        # The _Tracker recording reads for an AutoComputed, while one runs.
+        self._tracker = None
+        # Events which have occurred so far in the current tick.
+        self._fired = []
+        # Statistics.
+        self.ticks = 0
+        self.updates = 0
+    def tick(self):
+        """Update all reactives based on changes to refs.
+
+        Inside a `batch()` block this does nothing; the block ticks once at its
+        end instead.
+        """
+        if not self._batch_depth:
+            self._propagate()
+    @contextmanager
+    def batch(self):
+        """Coalesce ticks: tick() calls inside the block are deferred to its end."""
+        self._batch_depth += 1
+        try:
+            yield
+        finally:
+            self._batch_depth -= 1
+        self.tick()
+    @contextmanager
+    def activate(self):
+        """Make this the current runtime inside the block, on this thread."""
+        old = current_runtime()
+        _local.runtime = self
+        try:
+            yield self
+        finally:
+            _local.runtime = old
+    def _propagate(self):
+        # Reactives are processed in order of rank, which is kept greater than
+        # the rank of everything they depend on (see Reactive.link), so a heap
+        # of the loud-reachable reactives gives a topological order without
+        # re-sorting the graph each tick.
+        profiler = self.profiler
+        if profiler is not None:
+            tick_start = perf_counter()
+        to_update = self._to_update
+        heap = [(r._rank, i, r) for i, r in enumerate(to_update)]
+        heapq.heapify(heap)
+        queued = set(to_update)
+        count = len(heap)
+        # Clear the update set before running any external code, so any changes
+        # are correctly remembered for next tick.
+        to_update.clear()
+        update_order = []
+        fired = self._fired = []
+        changed = 0
+        equal = self.equal
+        deferred = set()
+        while heap:
+            rank, _, r = heapq.heappop(heap)
+            if deferred and r in deferred:
+                # A ParallelComputed's deferred comparison.
+                deferred.discard(r)
+                if equal(r.next_value, r()):
                     continue
-                stack.append(r)
-                stack += r.links
-                #
-                if r in loud_reachable:
-                    loud_reachable |= r.links
-                stack += r.quiet_links
-                enumerated.add(r)
             else:
-                # Yes? No need to process it.
-                # Move insertion point to before r.
-                insert_point = max(topo_i, insert_point)
-        topo_sort[insert_point + 1:insert_point + 1] = current_sort
-
-    # Clear the update set before running any external code, so any changes are
-    # correctly remembered for next tick.
-    _to_update.clear()
-    update_order = [r for r in reversed(topo_sort) if r in loud_reachable]
-    for r in update_order:
-        r.update()
-        for f in r._flags: f._value = True
-    for r in update_order:
-        if r.log:
-            print(f"{r.log!r} <- {r.next_value}")
-        r.finish_update()
+                if rank != r._rank:
+                    # Re-ranked by a link made during this tick; requeue at its
+                    # new place.
+                    heapq.heappush(heap, (r._rank, count, r))
+                    count += 1
+                    continue
+                if profiler is not None:
+                    start = perf_counter()
+                r.update()
+                update_order.append(r)
+                if r.next_events:
+                    fired.append(r)
+                    cut_off = False
+                elif equal is not None and getattr(r, '_future', None) is not None:
+                    # Comparing would wait for the result, so do it after the
+                    # rest of this rank has updated, but before its links.
+                    deferred.add(r)
+                    heapq.heappush(heap, (r._rank + 0.5, count, r))
+                    count += 1
+                    cut_off = True
+                else:
+                    cut_off = equal is not None and equal(r.next_value, r())
+                if profiler is not None:
+                    profiler.record_update(r, start, perf_counter())
+                if cut_off:
+                    continue
+            changed += 1
+            for f in r._flags: f._value = True
+            for l in r.links:
+                if l not in queued:
+                    queued.add(l)
+                    heapq.heappush(heap, (l._rank, count, l))
+                    count += 1
+        error = None
+        for r in update_order:
+            try:
+                if r.log:
+                    print(f"{r.log!r} <- {r.next_value}")
+                r.finish_update()
+            except Exception as e:
+                # e.g. a ParallelComputed's function failed. Finish the rest
+                # anyway, so the graph isn't left half-updated.
+                if error is None:
+                    error = e
+        self.ticks += 1
+        self.updates += len(update_order)
+        if profiler is not None:
+            profiler.record_tick(tick_start, perf_counter(), len(update_order), changed)
+        if error is not None:
+            raise error
+
+class Profiler:
+    """Timings of a runtime's ticks and reactive updates.
+
+    Attach one with `Runtime(profiler=Profiler())` or by setting
+    runtime.profiler. For each tick it records its duration, the number of
+    reactives visited (updated) and the number which changed (weren't cut
+    off). For each reactive it accumulates update calls and time, labelled by
+    its log name or origin. (Computeds are evaluated lazily, so their time
+    counts towards whatever reads them first, unless the runtime cuts off.)
+    If trace is true, it also keeps every event for chrome_trace().
+    """
+    def __init__(self, *, trace=False):
+        self.ticks = []
+        self.reactives = {}
+        self._trace = [] if trace else None
+    def record_update(self, r, start, end):
+        stats = self.reactives.get(r)
+        if stats is None:
+            stats = self.reactives[r] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += end - start
+        if self._trace is not None:
+            self._trace.append((label(r), start, end))
+    def record_tick(self, start, end, visited, changed):
+        self.ticks.append((start, end - start, visited, changed))
+        if self._trace is not None:
+            self._trace.append(("tick", start, end))
+    def report(self, limit=20):
+        """A text summary of ticks and the slowest reactives."""
+        lines = []
+        if self.ticks:
+            durations = sorted(t[1] for t in self.ticks)
+            n = len(durations)
+            lines.append(f"{n} ticks: mean {sum(durations) / n * 1e3:.3f} ms, "
+                f"p95 {durations[min(int(n * 0.95), n - 1)] * 1e3:.3f} ms, "
+                f"max {durations[-1] * 1e3:.3f} ms, "
+                f"mean {sum(t[2] for t in self.ticks) / n:.1f} visited, "
+                f"{sum(t[3] for t in self.ticks) / n:.1f} changed")
+        lines.append(f"{'reactive':<40}{'calls':>8}{'total ms':>12}{'mean us':>10}")
+        by_time = sorted(self.reactives.items(), key=lambda item: item[1][1], reverse=True)
+        for r, (calls, total) in by_time[:limit]:
+            lines.append(f"{label(r)[:39]:<40}{calls:>8}{total * 1e3:>12.3f}{total / calls * 1e6:>10.1f}")
+        return "\n".join(lines)
+    def chrome_trace(self, file):
+        """Write recorded events as Chrome trace JSON (for chrome://tracing or Perfetto)."""
+        if self._trace is None:
+            raise ValueError("profiler was created without trace=True")
+        events = [
+            {'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6, 'pid': 0, 'tid': 0}
+            for name, start, end in self._trace
+        ]
+        with open(file, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+def label(r):
+    """A short name for a reactive, for debugging output."""
+    if r.log is not None:
+        return str(r.log)
+    if r._origin is not None:
+        return f"{r.__class__.__name__} at {_format_origin(r._origin)}"
+    return f"{r.__class__.__name__} {id(r):#x}"
+
+def equal(a, b):
+    """Equality for cutting off ticks, which also compares NumPy arrays."""
+    if a is b:
+        return True
+    if hasattr(a, '__array__') or hasattr(b, '__array__'):
+        import numpy
+        return numpy.array_equal(a, b)
+    try:
+        return bool(a == b)
+    except ValueError:
+        # e.g. tuples of arrays, whose == is ambiguous.
+        return False
+
+_local = threading.local()
+default_runtime = Runtime()
+
+def current_runtime():
+    """The runtime new reactives are created in, on this thread."""
+    return getattr(_local, 'runtime', default_runtime)
+
+def tick():
+    """Tick the current runtime. See Runtime.tick."""
+    current_runtime().tick()
+
+def batch():
+    """Batch ticks in the current runtime. See Runtime.batch."""
+    return current_runtime().batch()
+
+_empty = frozenset()
+_first = itemgetter(0)
+# Orders Reducer processors by when they were added.
+_order = count()
+_capture_origins = False
+_globals = globals()
+
+def capture_origins(enabled=True):
+    """Turn on calling set_origin() for every reactive created from now on."""
+    global _capture_origins
+    _capture_origins = enabled
+
+# The code of every Reactive subclass's __init__, by id, for finding creation
+# sites. Hashing code objects is slow; keeping them here stops ids being reused.
+_init_codes = {}
+
+def _creation_site(frame):
+    # Skip this module and the initialisers of reactives (such as subclasses'
+    # calling super().__init__()), but not other classes' initialisers.
+    while (frame.f_globals is _globals or frame.f_code.co_name == '__init__'
+                and id(frame.f_code) in _init_codes) and frame.f_back is not None:
+        frame = frame.f_back
+    # Only keep the code object and bytecode offset; finding the line number
+    # is relatively slow, so it's done when formatting.
+    return frame.f_code, frame.f_lasti
+
+def _format_origin(origin):
+    code, offset = origin
+    lineno = next((line for start, end, line in code.co_lines() if start <= offset < end), None)
+    return f"{code.co_name}:{lineno}"
 
 class Reactive:
     """Base class for a reactive value.
@@ -56,18 +283,42 @@ class Reactive:
 
     To create a custom reactive, subclass this and:
 
-    -   call Reactive.setup() at the end of your own initialiser
+    -   call Reactive.setup() in your own initialiser, before linking it to
+        other reactives, passing the first reactive it depends on (if any)
     -   set self.is_event, self._value
-    -   override update() to set self.next_value to the new value
+    -   override update() to set self.next_value to the new value, and for
+        events, self.next_events to the list of values which occurred this
+        tick (next_value being the last)
 
-    To make a reactive B depend on another one A, do `A.links.add(B)`. Note that
+    To make a reactive B depend on another one A, do `A.link(B)`. Note that
     to use A's new value, B needs to refer to A.next_value in its update
-    method, not A().
+    method, not A(). `A.quiet_link(B)` orders B after A without causing B to
+    update when A changes.
+
+    Reactives use __slots__ to stay small; subclasses should declare their own
+    __slots__ for any attributes they add.
     """
-    def setup(self):
-        self.links = set()
-        self.quiet_links = set()
-        self._flags = set()
+    __slots__ = ('links', 'quiet_links', '_flags', '_rank', '_runtime', '_version', '_value', 'next_value', 'next_events', 'is_event', 'log', '_origin')
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        code = getattr(cls.__dict__.get('__init__'), '__code__', None)
+        if code is not None:
+            _init_codes[id(code)] = code
+    def setup(self, dep=None):
+        # Reactives derived from others join their runtime, so they can be
+        # made outside it, e.g. in an event handler. Others join the current
+        # one.
+        self._runtime = dep._runtime if dep is not None else current_runtime()
+        # Most reactives are never linked to or flagged, so these share one
+        # empty container until they are.
+        self.links = self.quiet_links = self._flags = _empty
+        self.next_events = ()
+        # Incremented whenever the value may have changed, for lazy Computeds
+        # to check their dependencies against.
+        self._version = 0
+        # Rank is greater than the rank of everything linked to this reactive,
+        # giving tick() its update order.
+        self._rank = 0
         # We require an initial value because otherwise we'd need a safe
         # .get(default) for uninitialised reactives, and in Python you can't
         # pick default values in type-generic cases. In a language with
@@ -75,19 +326,72 @@ class Reactive:
         # possible.
         self.log = None
         self._origin = None
+        if _capture_origins:
+            # Inlined set_origin(), skipping this frame and the initialiser's,
+            # since this runs for every reactive.
+            frame = _getframe(2)
+            while (frame.f_globals is _globals or frame.f_code.co_name == '__init__'
+                    and id(frame.f_code) in _init_codes) and frame.f_back is not None:
+                frame = frame.f_back
+            self._origin = (frame.f_code, frame.f_lasti)
+    def link(self, r):
+        """Make r update whenever this reactive does."""
+        self._observe()
+        self._rerank(r)
+        if self.links is _empty:
+            self.links = set()
+        self.links.add(r)
+    def quiet_link(self, r):
+        """Make r update after this reactive, without depending on it."""
+        self._observe()
+        self._rerank(r)
+        if self.quiet_links is _empty:
+            self.quiet_links = set()
+        self.quiet_links.add(r)
+    def _observe(self):
+        """Called when something starts to depend on this reactive updating."""
+    def unlink(self, r):
+        if self.links: self.links.discard(r)
+        if self.quiet_links: self.quiet_links.discard(r)
+    def _rerank(self, r):
+        # Raise the ranks downstream of r until they are consistent again. Ranks
+        # are never lowered on unlink; they only need to be an upper bound.
+        if r is self:
+            raise ValueError(f"{label(self)} cannot be linked to itself")
+        if r._runtime is not self._runtime:
+            raise ValueError(f"{label(self)} and {label(r)} belong to different runtimes")
+        if r._rank > self._rank:
+            return
+        r._rank = self._rank + 1
+        stack = [r]
+        while stack:
+            s = stack.pop()
+            for l in (*s.links, *s.quiet_links):
+                if l is self:
+                    # Use r() instead of linking to read a value circularly.
+                    raise ValueError(f"linking {label(self)} to {label(r)} creates a cycle")
+                if l._rank <= s._rank:
+                    l._rank = s._rank + 1
+                    stack.append(l)
     def set_origin(self):
-        import inspect
-        frame = inspect.currentframe()
-        tb = inspect.getframeinfo(frame.f_back.f_back.f_back)
-        self._origin = f"{tb.function}:{tb.lineno}"
+        """Remember where this reactive was created, for debugging output.
+
+        The creation site is the first caller outside this module and outside
+        any __init__, so subclasses' initialisers are skipped.
+        """
+        self._origin = _creation_site(_getframe(1))
     def __str__(self):
         name = f"{self.log!r} " if self.log is not None else ""
-        origin = f"at {self._origin} " if self._origin is not None else ""
-        return f"<{name}{origin}{self.__class__.__name__}: {self._value}>"
+        origin = f"at {_format_origin(self._origin)} " if self._origin is not None else ""
+        return f"<{name}{origin}{self.__class__.__name__}: {self()}>"
     def __call__(self):
+        if self._runtime._tracker is not None:
+            return self._runtime._tracker.read(self)
         return self._value
     def finish_update(self):
         self._value = self.next_value
+        self.next_events = ()
+        self._version += 1
 
 def as_ref(x):
     """Turns a value into a reactive, if it isn't already."""
@@ -97,97 +401,403 @@ def as_ref(x):
 
 class Ref(Reactive):
     """Settable input reactive."""
+    __slots__ = ('_driver', '_queue')
     def __init__(self, value, is_event=False):
         Reactive.setup(self)
         self._value = self.next_value = value
         self.is_event = is_event
         self._driver = None
+        self._queue = None
     def update(self):
         if self._driver:
             self.next_value = self._driver.next_value
+            self.next_events = self._driver.next_events
+        elif self._queue is not None:
+            self.next_events = self._queue
+            self._queue = None
     def set(self, x):
+        if self.is_event:
+            # Keep every event set before the next tick, not just the last.
+            if self._queue is None:
+                self._queue = []
+            self._queue.append(x)
         self.next_value = x
-        _to_update.add(self)
+        self._runtime._to_update.add(self)
     def __lshift__(self, r):
         # We can have circularity in reference to reactives even without circularity in deps (pull sampling).
         if self.is_event != r.is_event:
             raise ValueError()
         if self._driver:
-            self._driver.links.remove(self)
+            self._driver.unlink(self)
         self._driver = r
-        self._driver.links.add(self)
+        self._driver.link(self)
 
 ref = Ref
 
 class read_only(Reactive):
+    __slots__ = ('_ref',)
     def __init__(self, ref):
-        Reactive.setup(self)
+        Reactive.setup(self, ref)
         self._value = self.next_value = ref()
         self.is_event = ref.is_event
         self._ref = ref
-        ref.links.add(self)
+        ref.link(self)
     def update(self):
         self.next_value = self._ref.next_value
+        self.next_events = self._ref.next_events
 
-def computed(*args):
-    """Reactive function."""
-    def builder(f):
-        return Computed(f, *args)
-    return builder
+def computed(deps, *, parallel=False, **kwargs):
+    """Reactive function.
+
+    Pass parallel=True for a ParallelComputed. (Not with a process pool: the
+    decorator rebinds the function's name, so it can't be pickled.)
+    """
+    # A partial rather than a closure, so it adds no frame for set_origin() to
+    # skip.
+    return partial(ParallelComputed if parallel else Computed, deps=deps, **kwargs)
 
-# we could still do auto-detecting dependencies, we'd just have to swap out () to next value during execution. it that safe?
 class Computed(Reactive):
-    def __init__(self, function, deps, *, is_event=False, data=None):
+    """Reactive function of deps.
+
+    A Computed is only evaluated when its value is read. If lazy is true (by
+    default, if its runtime is lazy), it also isn't linked to its deps, so ticks
+    don't visit it at all: instead, reading it checks whether its deps have
+    changed since it was last evaluated. Once anything links to or flags it, it
+    is linked to its deps like a normal Computed, since it then needs to
+    update during ticks.
+    """
+    # _value and _next are caches for the current and next values, valid unless
+    # _stale and _next_stale are set. _versions is None unless lazy and
+    # unobserved, when it has the deps' versions at the last evaluation, and
+    # _checked is the runtime tick it was last checked on.
+    __slots__ = ('_function', '_deps', '_data', '_stale', '_next', '_next_stale', '_versions', '_checked')
+    def __init__(self, function, deps, *, is_event=False, data=None, lazy=None):
         self._function = function
         self._deps = deps
         self._data = data
-        for ref in deps:
-            ref.links.add(self)
-        Reactive.setup(self)
-        self._cached = self._cached_next = (True, None)
+        Reactive.setup(self, deps[0] if deps else None)
+        self._value = self._next = None
+        self._stale = self._next_stale = True
         self.is_event = False
+        self._versions = None
+        if lazy if lazy is not None else self._runtime.lazy:
+            self._versions = ()
+            self._checked = None
+        else:
+            for ref in deps:
+                ref.link(self)
+    def _observe(self):
+        if self._versions is not None:
+            self._versions = None
+            self._stale = self._next_stale = True
+            for ref in self._deps:
+                ref.link(self)
     def update(self):
-        self._cached_next = (True, None)
+        self._next_stale = True
     def finish_update(self):
-        self._cached = self._cached_next
+        self._value = self._next
+        self._stale = self._next_stale
+        self._version += 1
     def __call__(self):
-        if self._cached[0]:
+        if self._runtime._tracker is not None:
+            return self._runtime._tracker.read(self)
+        if self._versions is not None:
+            return self._pull()
+        if self._stale:
             args = [r() for r in self._deps]
             if self._data is not None:
                 args.append(self._data)
-            self._cached = (False, self._function(*args))
-        return self._cached[1]
+            self._value = self._function(*args)
+            self._stale = False
+        return self._value
+    def _pull(self):
+        # Values only change during ticks, so checking once per tick is enough.
+        ticks = self._runtime.ticks
+        if self._checked == ticks:
+            return self._value
+        args = [r() for r in self._deps]
+        versions = tuple(r._version for r in self._deps)
+        if self._stale or versions != self._versions:
+            if self._data is not None:
+                args.append(self._data)
+            self._value = self._function(*args)
+            self._stale = False
+            self._versions = versions
+            self._version += 1
+        self._checked = ticks
+        return self._value
     @property
     def next_value(self):
-        if self._cached_next[0]:
+        if self._versions is not None:
+            # Not cached, since nothing tells an unobserved Computed when its
+            # deps' next values change.
             args = [r.next_value for r in self._deps]
             if self._data is not None:
                 args.append(self._data)
-            self._cached_next = (False, self._function(*args))
-        return self._cached_next[1]
+            return self._function(*args)
+        if self._next_stale:
+            args = [r.next_value for r in self._deps]
+            if self._data is not None:
+                args.append(self._data)
+            self._next = self._function(*args)
+            self._next_stale = False
+        return self._next
+
+class ParallelComputed(Computed):
+    """Computed whose function is run on its runtime's executor, if it has one.
+
+    Use this for expensive, pure functions which can run concurrently, e.g.
+    NumPy work which releases the GIL. When it updates, its function is
+    submitted to the executor straight away with its dependencies' next
+    values, so every such computed whose dependencies are ready runs
+    concurrently; reading its next value waits for the result. Results are
+    identical to running serially.
+
+    With a ProcessPoolExecutor, the function and its arguments must be
+    picklable, so create it as ParallelComputed(f, deps) with f defined at
+    module level under its own name, rather than with the computed()
+    decorator, which rebinds the name. Without an executor this behaves like
+    Computed.
+
+    If the function raises, its next value is its current one for the rest
+    of the tick, which still finishes updating the rest of the graph and then
+    raises the error. It's recomputed when next read.
+    """
+    # _error is the exception from the function this tick, if it raised.
+    __slots__ = ('_future', '_error')
+    def __init__(self, *args, **kwargs):
+        # Never lazy, since it has to update to be submitted.
+        Computed.__init__(self, *args, lazy=False, **kwargs)
+        self._future = None
+        self._error = None
+    def update(self):
+        executor = self._runtime.executor
+        if executor is None:
+            return Computed.update(self)
+        args = [r.next_value for r in self._deps]
+        if self._data is not None:
+            args.append(self._data)
+        self._future = executor.submit(self._function, *args)
+        self._next_stale = False
+    def finish_update(self):
+        self._resolve()
+        Computed.finish_update(self)
+        error = self._error
+        if error is not None:
+            self._error = None
+            self._stale = True
+            # The runtime raises it once the tick is finished.
+            raise error
+    def _resolve(self):
+        future = self._future
+        if future is not None:
+            self._future = None
+            try:
+                self._next = future.result()
+            except Exception as e:
+                # Don't raise while the tick is updating, which would abandon
+                # it; finish_update raises it instead.
+                self._error = e
+                self._next = self._value
+    @property
+    def next_value(self):
+        self._resolve()
+        return Computed.next_value.fget(self)
+
+def auto_computed(f):
+    """Reactive function of whatever it reads. See AutoComputed."""
+    return AutoComputed(f)
+
+class AutoComputed(Reactive):
+    """Reactive function which tracks its own dependencies.
+
+    The function takes no arguments and reads other reactives by calling them.
+    The reactives it read during its last evaluation are its dependencies, so
+    it only recomputes when one of those changes, not when an input on a
+    branch it didn't take does. During a tick, calling a reactive inside the
+    function gives its next value.
+
+    Unlike Computed, it is evaluated eagerly each time it updates, in order to
+    find its new dependencies. A reactive which is newly read during a tick
+    should already have its next value, like refs and Computeds do;
+    dependencies are only reordered before it from the next tick.
+    """
+    __slots__ = ('_function', '_deps')
+    def __init__(self, function):
+        self._function = function
+        self._deps = set()
+        Reactive.setup(self)
+        self._value = self.next_value = self._evaluate(False)
+        self.is_event = False
+    def update(self):
+        self.next_value = self._evaluate(True)
+    def _evaluate(self, next):
+        runtime = self._runtime
+        tracker = _Tracker(runtime, next)
+        outer = runtime._tracker
+        runtime._tracker = tracker
+        try:
+            value = self._function()
+        finally:
+            runtime._tracker = outer
+        reads = tracker.reads.keys() - {self}
+        for r in self._deps - reads:
+            r.unlink(self)
+        for r in reads - self._deps:
+            r.link(self)
+        self._deps = reads
+        return value
+
+class _Tracker:
+    __slots__ = ('runtime', 'next', 'reads')
+    def __init__(self, runtime, next):
+        self.runtime = runtime
+        self.next = next
+        self.reads = {}
+    def read(self, r):
+        self.reads[r] = None
+        # Don't track reads made by r itself, e.g. by a Computed evaluating.
+        self.runtime._tracker = None
+        try:
+            return r.next_value if self.next else r()
+        finally:
+            self.runtime._tracker = self
+
+class ArrayRef(Reactive):
+    """Settable reactive holding a NumPy array, which is updated in place.
+
+    It keeps two preallocated arrays, for the current and next values, which
+    swap each tick, so updating doesn't allocate. Either set() a whole new
+    value, or write() into part of the next value. After a tick, dirty is the
+    list of indices which were written in it (empty if none were), e.g. for
+    uploading only those parts. Int indices are treated as slices, so write()
+    returns a view; indices which wouldn't give one, like advanced indices or
+    a single element, raise IndexError.
+
+    As the arrays are reused, a value is only valid until the tick after next;
+    copy it to keep it.
+    """
+    __slots__ = ('_dirty', '_dirty_tick', '_written')
+    def __init__(self, initial, dtype=None):
+        import numpy
+        Reactive.setup(self)
+        self._value = numpy.array(initial, dtype=dtype)
+        self.next_value = self._value.copy()
+        self.is_event = False
+        self._dirty = []
+        self._dirty_tick = None
+        self._written = []
+    @property
+    def dirty(self):
+        # finish_update runs before the runtime counts the tick.
+        if self._dirty_tick != self._runtime.ticks - 1:
+            return []
+        return self._dirty
+    def update(self):
+        pass
+    def set(self, x):
+        import numpy
+        numpy.copyto(self.next_value, x)
+        self._written = [slice(None)]
+        self._runtime._to_update.add(self)
+    def write(self, index=slice(None)):
+        """Return a view of part of the next value to write into.
+
+        It starts off holding the current value.
+        """
+        import numpy
+        if isinstance(index, Integral):
+            index = slice(index, index + 1 or None)
+        view = self.next_value[index]
+        # Otherwise writes to it would be lost.
+        if not isinstance(view, numpy.ndarray) or not numpy.may_share_memory(view, self.next_value):
+            raise IndexError(f"{index!r} doesn't index a view to write into")
+        self._written.append(index)
+        self._runtime._to_update.add(self)
+        return view
+    def finish_update(self):
+        self._value, self.next_value = self.next_value, self._value
+        # Bring the new next value up to date with what was written.
+        for index in self._written:
+            self.next_value[index] = self._value[index]
+        self._dirty = self._written
+        self._dirty_tick = self._runtime.ticks
+        self._written = []
+        self._version += 1
+
+def array_computed(deps, shape, dtype=float):
+    """Reactive function writing into a NumPy array. See ArrayComputed."""
+    return partial(ArrayComputed, deps=deps, shape=shape, dtype=dtype)
+
+class ArrayComputed(Reactive):
+    """Reactive function whose value is a NumPy array of fixed shape.
+
+    The function is called with the deps' values and an `out` keyword
+    argument, an array it must fill in completely. Like ArrayRef, two arrays
+    are preallocated and swapped each tick, so updating doesn't allocate, and
+    a value is only valid until the tick after next.
+
+    Unlike Computed, it is evaluated eagerly when it updates. After a tick,
+    dirty is [slice(None)] if it updated in it, else empty, like ArrayRef's.
+    """
+    __slots__ = ('_function', '_deps', '_dirty_tick')
+    def __init__(self, function, deps, shape, dtype=float):
+        import numpy
+        self._function = function
+        self._deps = deps
+        Reactive.setup(self, deps[0] if deps else None)
+        for ref in deps:
+            ref.link(self)
+        self._value = numpy.empty(shape, dtype)
+        self.is_event = False
+        self._dirty_tick = None
+        function(*[r() for r in deps], out=self._value)
+        self.next_value = self._value.copy()
+    @property
+    def dirty(self):
+        # finish_update runs before the runtime counts the tick.
+        if self._dirty_tick != self._runtime.ticks - 1:
+            return []
+        return [slice(None)]
+    def update(self):
+        self._function(*[r.next_value for r in self._deps], out=self.next_value)
+    def finish_update(self):
+        import numpy
+        self._value, self.next_value = self.next_value, self._value
+        # Dependents read next_value in ticks where this doesn't update too, so
+        # it must hold the current value until it's next written.
+        numpy.copyto(self.next_value, self._value)
+        self._dirty_tick = self._runtime.ticks
+        self._version += 1
 
 class gate(Reactive):
+    __slots__ = ('_open', '_reactive')
     def __init__(self, open, reactive):
         self._open = open
-        self._open.links.add(self)
         self._reactive = reactive
+        Reactive.setup(self, open)
+        self._open.link(self)
         if self._open():
-            self._reactive.links.add(self)
-        Reactive.setup(self)
+            self._reactive.link(self)
         self._value = self.next_value = reactive() if open() else None
         self.is_event = reactive.is_event
     def update(self):
-        if self._open():
-            self._reactive.links.add(self)
+        if self._open.next_value:
+            self._reactive.link(self)
             self.next_value = self._reactive.next_value
+            self.next_events = self._reactive.next_events
         else:
-            self._reactive.links.remove(self)
+            self._reactive.unlink(self)
 
 def gate_context(ctx, open, keys):
     return ctx.add({key: gate(open, ctx[key]) for key in keys})
 
 class Flag:
+    __slots__ = ('_value',)
     def __init__(self, reactive):
+        reactive._observe()
+        if reactive._flags is _empty:
+            reactive._flags = set()
         reactive._flags.add(self)
         self._value = False
     def pop(self):
@@ -196,48 +806,93 @@ class Flag:
         return value
 
 class sample(Reactive):
+    __slots__ = ('_reactive', '_event')
     def __init__(self, reactive, event):
         self._reactive = reactive
         self._event = event
-        self._event.links.add(self)
-        Reactive.setup(self)
+        Reactive.setup(self, event)
+        self._event.link(self)
         self._value = self.next_value = self._reactive()
         self.is_event = False
     def update(self):
-        self.next_value = self._reactive()
+        if self._event.next_events:
+            self.next_value = self._reactive()
 
 class Reducer(Reactive):
+    # _by_event indexes processors by their event, as (order added, event,
+    # deps, function) tuples, in a tuple for events with one processor (most
+    # of them) or else a list. It's their only copy, to keep reducers small;
+    # processors rebuilds the list in order.
+    __slots__ = ('_by_event',)
     def __init__(self, initial):
-        self.processors = []
+        self._by_event = {}
         Reactive.setup(self)
         self._value = self.next_value = initial
         self.is_event = True
+    @property
+    def processors(self):
+        """The [event, deps, function] processors, in the order they were added."""
+        ps = sorted((p for ps in self._by_event.values() for p in ps), key=_first)
+        return [[event, list(deps), f] for _, event, deps, f in ps]
     def reduce(self, event, deps=[]):
         if not event.is_event:
             raise ValueError("first argument to reduce must be an event")
-        event.links.add(self)
+        event.link(self)
         for r in deps:
-            r.quiet_links.add(self)
+            r.quiet_link(self)
         def wrap(f):
-            self.processors.append([event, deps, f])
+            processor = (next(_order), event, tuple(deps), f)
+            processors = self._by_event.get(event)
+            if processors is None:
+                self._by_event[event] = (processor,)
+            elif type(processors) is tuple:
+                self._by_event[event] = [*processors, processor]
+            else:
+                processors.append(processor)
         return wrap
     def update(self):
-        for event, deps, reducer in self.processors:
-            if event.next_value is not None:
-                self.next_value = reducer(self.next_value, event.next_value, *[d.next_value for d in deps])
+        # Only visit processors whose events fired, by going through whichever
+        # is smaller of the events fired so far this tick and our events.
+        fired = self._runtime._fired
+        by_event = self._by_event
+        if len(fired) < len(by_event):
+            matched = [p for e in fired if e in by_event for p in by_event[e]]
+        else:
+            matched = [p for e, ps in by_event.items() if e.next_events for p in ps]
+        if len(matched) > 1:
+            # Back into the order they were added.
+            matched.sort(key=_first)
+        state = self.next_value
+        states = []
+        for _, event, deps, reducer in matched:
+            if deps:
+                args = [d.next_value for d in deps]
+                for e in event.next_events:
+                    state = reducer(state, e, *args)
+                    states.append(state)
+            else:
+                for e in event.next_events:
+                    state = reducer(state, e)
+                    states.append(state)
+        self.next_value = state
+        self.next_events = states
 
 class process_event(Reactive):
+    __slots__ = ('_f', '_event', '_state')
     def __init__(self, f, event, state):
         self._f = f
         self._event = event
-        self._event.links.add(self)
         self._state = state
-        Reactive.setup(self)
+        Reactive.setup(self, event)
+        self._event.link(self)
         self._value = self.next_value = self._state
         self.is_event = True
     def update(self):
-        if self._event.next_value is not None:
-            self._state, self.next_value = self._f(self._state, self._event.next_value)
+        outputs = []
+        for e in self._event.next_events:
+            self._state, self.next_value = self._f(self._state, e)
+            outputs.append(self.next_value)
+        self.next_events = outputs
 
 def reduce_event(f, event, init):
     def reduce(a, e):
@@ -261,12 +916,13 @@ class Context:
         return self._data[k]
 
 class process_sample_unsafe(Reactive):
+    __slots__ = ('_reduce', '_time', '_state')
     def __init__(self, reduce, time, state):
         self._reduce = reduce
         self._time = time
-        self._time.links.add(self)
         self._state = state
-        Reactive.setup(self)
+        Reactive.setup(self, time)
+        self._time.link(self)
         self._value = self.next_value = self._state
         self.is_event = False
     def update(self):
@@ -286,6 +942,79 @@ def integrate(r, time, initial=0.0):
         return new_total
     return reduce_sample_unsafe(f, time, initial)
 
+class fixed_step(Reactive):
+    """Reactive state stepped forward in fixed increments of dt as time passes.
+
+    Each tick, the time elapsed is added to an accumulator, and the state is
+    advanced by step(state, t, dt, *args) once for each whole dt in it, so the
+    result doesn't depend on the frame rate. args are the current values of
+    the reactives in args. At most max_steps are taken per tick; any more time
+    than that is dropped, so a slow frame doesn't snowball. Time going
+    backwards is ignored.
+
+    State can be a NumPy array (or tuple of arrays, for semi_implicit_euler),
+    so many objects can be integrated at once. See euler, semi_implicit_euler
+    and rk4 for steppers.
+    """
+    __slots__ = ('_step', '_time', '_dt', '_max_steps', '_args', '_t', '_accumulator')
+    def __init__(self, step, time, state, *, dt=1/120, max_steps=8, args=()):
+        self._step = step
+        self._time = time
+        self._dt = dt
+        self._max_steps = max_steps
+        self._args = args
+        self._t = time()
+        self._accumulator = 0.0
+        Reactive.setup(self, time)
+        time.link(self)
+        self._value = self.next_value = state
+        self.is_event = False
+    def update(self):
+        self._accumulator += max(self._time.next_value - self._time(), 0.0)
+        # Allow for rounding error, e.g. so 0.1 elapsed is one step of 0.1.
+        steps = int(self._accumulator / self._dt + 1e-6)
+        self._accumulator -= steps * self._dt
+        state = self._value
+        t = self._t
+        dt = self._dt
+        args = [r() for r in self._args]
+        for _ in range(min(steps, self._max_steps)):
+            state = self._step(state, t, dt, *args)
+            t += dt
+        self._t += steps * dt
+        self.next_value = state
+
+def euler(f):
+    """Explicit Euler stepper for fixed_step, where f(state, t, *args) is the
+    derivative of the state."""
+    def step(x, t, dt, *args):
+        return x + f(x, t, *args) * dt
+    return step
+
+def semi_implicit_euler(a):
+    """Semi-implicit (symplectic) Euler stepper for fixed_step, for a
+    (position, velocity) state where a(x, v, t, *args) is the acceleration.
+
+    Costs the same as Euler but keeps oscillating systems stable.
+    """
+    def step(state, t, dt, *args):
+        x, v = state
+        v = v + a(x, v, t, *args) * dt
+        return x + v * dt, v
+    return step
+
+def rk4(f):
+    """Fourth-order Runge-Kutta stepper for fixed_step, where f(state, t,
+    *args) is the derivative of the state."""
+    def step(x, t, dt, *args):
+        h = dt / 2
+        k1 = f(x, t, *args)
+        k2 = f(x + k1 * h, t + h, *args)
+        k3 = f(x + k2 * h, t + h, *args)
+        k4 = f(x + k3 * dt, t + dt, *args)
+        return x + (k1 + 2 * k2 + 2 * k3 + k4) * (dt / 6)
+    return step
+
 # TODO not rate-independent?
 def toggle(r, initial=False):
     @computed([r], data={'last': r(), 'out': initial})
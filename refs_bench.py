@@ -0,0 +1,234 @@
+"""Benchmarks for the refs.py propagation engine.
+
+Builds synthetic graphs without any window or GL and reports tick throughput,
+per-tick latency percentiles and peak memory for each graph size:
+
+    python refs_bench.py                      # all graphs, default sizes
+    python refs_bench.py chain diamond -n 100 1000 10000 -t 200
+    python refs_bench.py --lazy --idle        # lazy Computeds nobody reads
+    python refs_bench.py --memory             # bytes per reactive of each kind
+    python refs_bench.py --origins            # graph construction cost of capture_origins()
+"""
+import argparse
+import gc
+import sys
+import statistics
+import tracemalloc
+from time import perf_counter
+
+import refs
+from refs import (ArrayRef, Ref, Reducer, array_computed, computed, fixed_step, gate, integrate,
+    reduce_event, sample, semi_implicit_euler)
+
+# Each graph builder takes a size and returns (step, reads): step(i) sets the
+# inputs for tick i, and reads are the reactives called after each tick, in an
+# order where every dependency is read before its dependents (like a draw pass).
+
+def chain(n):
+    x = Ref(0)
+    reads = [x]
+    for _ in range(n):
+        reads.append(computed([reads[-1]])(lambda v: v + 1))
+    return x.set, reads
+
+def fan_out(n):
+    x = Ref(0)
+    reads = [computed([x])(lambda v, k=k: v * k) for k in range(n)]
+    return x.set, reads
+
+def diamond(n):
+    # n/2 stacked diamonds: each layer has two computeds reading both of the
+    # previous layer's.
+    x = Ref(0)
+    a = b = x
+    reads = []
+    for _ in range(max(n // 2, 1)):
+        a, b = computed([a, b])(lambda a, b: a + b), computed([a, b])(lambda a, b: a - b)
+        reads += [a, b]
+    return x.set, reads
+
+def reducer_stack(n):
+    e = Ref(None, is_event=True)
+    top = e
+    reads = []
+    for _ in range(n):
+        r = Reducer(0)
+        r.reduce(top)(lambda s, v: s + 1)
+        reads.append(r)
+        top = r
+    return e.set, reads
+
+def reducer_handlers(n):
+    # One Reducer with a processor for each of n events, one of which fires
+    # each tick.
+    events = [Ref(None, is_event=True) for _ in range(n)]
+    x = Ref(1)
+    r = Reducer(0)
+    for i, e in enumerate(events):
+        if i % 2:
+            r.reduce(e)(lambda s, v: s + v)
+        else:
+            r.reduce(e, [x])(lambda s, v, x: s + v * x)
+    return (lambda i: events[i % n].set(i)), [r]
+
+def gated(n):
+    # n gates over one source, all opening and closing every 10 ticks.
+    x = Ref(0)
+    open = Ref(True)
+    reads = [gate(open, x) for _ in range(n)]
+    def step(i):
+        x.set(i)
+        if i % 10 == 0:
+            open.set(not open())
+    return step, reads
+
+def integrate_loop(n):
+    # n damped springs, each position integrating a velocity computed from it.
+    t = Ref(0.0)
+    reads = []
+    for _ in range(n):
+        pos = Ref(1.0)
+        vel = computed([pos])(lambda p: -p)
+        pos << integrate(vel, t, pos())
+        reads.append(pos)
+    return (lambda i: t.set(i / 60)), reads
+
+def fixed_step_springs(n):
+    # The same springs as integrate_loop, as one array stepped by fixed_step.
+    import numpy
+    t = Ref(0.0)
+    springs = semi_implicit_euler(lambda x, v, t: -x)
+    state = fixed_step(springs, t, (numpy.ones(n), numpy.zeros(n)), dt=1/60)
+    return (lambda i: t.set(i / 60)), [state]
+
+def array_update(n):
+    # n particles stepped in place by an ArrayComputed, with a tenth of their
+    # velocities rewritten each tick.
+    import numpy
+    vel = ArrayRef(numpy.zeros((n, 2)))
+    pos = ArrayRef(numpy.zeros((n, 2)))
+    step_pos = array_computed([pos, vel], (n, 2))(
+        lambda p, v, out: numpy.add(p, v, out=out))
+    def step(i):
+        numpy.copyto(pos.write(), step_pos())
+        vel.write(slice(i % 10 * n // 10, (i % 10 + 1) * n // 10))[:] = i
+    return step, [vel, step_pos, pos]
+
+graphs = {
+    'chain': chain,
+    'fan_out': fan_out,
+    'diamond': diamond,
+    'reducer_stack': reducer_stack,
+    'reducer_handlers': reducer_handlers,
+    'gated': gated,
+    'integrate_loop': integrate_loop,
+    'fixed_step_springs': fixed_step_springs,
+    'array_update': array_update,
+}
+
+# Constructors for one reactive of each kind, given a value source and an event
+# source to depend on.
+kinds = {
+    'Ref': lambda x, e: Ref(0),
+    'Computed': lambda x, e: computed([x])(abs),
+    'Reducer': lambda x, e: Reducer(0),
+    'Reducer.reduce': lambda x, e: Reducer(0).reduce(e)(max) or None,
+    'gate': lambda x, e: gate(x, x),
+    'sample': lambda x, e: sample(x, e),
+    'reduce_event': lambda x, e: reduce_event(max, e, 0),
+}
+
+def bytes_per_reactive(make, n):
+    x = Ref(1)
+    e = Ref(None, is_event=True)
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    keep = [make(x, e) for _ in range(n)]
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    # Exclude the list holding them.
+    return (size - sys.getsizeof(keep)) / n
+
+def build_time(builder, n, repeats=5):
+    best = None
+    for _ in range(repeats):
+        gc.collect()
+        start = perf_counter()
+        builder(n)
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def run(builder, n, ticks, *, lazy=False, idle=False):
+    runtime = refs.Runtime(lazy=lazy)
+    with runtime.activate():
+        step, reads = builder(n)
+    runtime.tick()
+    if idle:
+        reads = []
+    times = []
+    for i in range(1, ticks + 1):
+        start = perf_counter()
+        step(i)
+        runtime.tick()
+        for r in reads: r()
+        times.append(perf_counter() - start)
+    return times
+
+def peak_memory(builder, n, ticks, **options):
+    gc.collect()
+    tracemalloc.start()
+    run(builder, n, ticks, **options)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def percentile(sorted_times, p):
+    return sorted_times[min(int(len(sorted_times) * p), len(sorted_times) - 1)]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('graphs', nargs='*', metavar='graph', help=f"one of {', '.join(graphs)} (default: all)")
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('-t', '--ticks', type=int, default=100)
+    parser.add_argument('--lazy', action='store_true', help="use lazy Computeds")
+    parser.add_argument('--idle', action='store_true', help="don't read the graph after each tick")
+    parser.add_argument('--memory', action='store_true', help="report bytes per reactive instead")
+    parser.add_argument('--origins', action='store_true', help="report graph construction time with and without capture_origins()")
+    args = parser.parse_args()
+    if args.memory:
+        for name, make in kinds.items():
+            print(f"{name:<16}{bytes_per_reactive(make, 10000):>8.0f} B")
+        return
+    for name in args.graphs:
+        if name not in graphs:
+            parser.error(f"unknown graph {name!r}")
+    if args.origins:
+        print(f"{'graph':<16}{'size':>8}{'off ms':>10}{'on ms':>10}{'overhead':>10}")
+        for name in args.graphs or graphs:
+            for n in args.sizes:
+                # Alternate so both settings see the same machine conditions.
+                off = on = float('inf')
+                for _ in range(5):
+                    off = min(off, build_time(graphs[name], n, 1))
+                    refs.capture_origins()
+                    on = min(on, build_time(graphs[name], n, 1))
+                    refs.capture_origins(False)
+                print(f"{name:<16}{n:>8}{off * 1e3:>10.3f}{on * 1e3:>10.3f}{(on / off - 1) * 100:>9.1f}%")
+        return
+    print(f"{'graph':<20}{'size':>8}{'ticks/s':>12}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KiB':>12}")
+    for name in args.graphs or graphs:
+        for n in args.sizes:
+            options = {'lazy': args.lazy, 'idle': args.idle}
+            times = sorted(run(graphs[name], n, args.ticks, **options))
+            # Memory is traced in a separate run since tracing slows ticks down.
+            peak = peak_memory(graphs[name], n, min(args.ticks, 10), **options)
+            print(f"{name:<20}{n:>8}{len(times) / sum(times):>12.1f}"
+                f"{statistics.median(times) * 1e3:>10.3f}"
+                f"{percentile(times, 0.95) * 1e3:>10.3f}"
+                f"{percentile(times, 0.99) * 1e3:>10.3f}"
+                f"{peak / 1024:>12.1f}")
+
+if __name__ == '__main__':
+    main()
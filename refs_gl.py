@@ -1,4 +1,5 @@
 import math
+from ctypes import Array
 from dataclasses import dataclass, field
 from datetime import datetime
 from collections import defaultdict
@@ -10,7 +11,8 @@ import pyglet
 from pyglet.gl import Config
 from pyglet.math import Vec2
 
-from refs import Context, as_ref, computed, Ref, Reactive, read_only, tick, Reducer, gate, reduce_event, integrate, Flag, gate_context, Active
+from refs import Context, as_ref, computed, Ref, Reactive, read_only, Runtime, equal, Reducer, gate, reduce_event, integrate, Flag, gate_context, Active
+from shader_cache import load_program
 
 def clear(*, color=(0, 0, 0, 255), depth=0):
     from pyglet.gl import glClear, glClearColor, glClearDepth, GL_COLOR_BUFFER_BIT, GL_DEPTH_BUFFER_BIT
@@ -41,49 +43,303 @@ class drag_zoom_view:
         # When zooming, we need to move center along the line passing through
         # target and the current center. So the new center is target + the
         # scaled target-to-center vector. We need to depend on target to ensure
-        # we zoom into the right place.
-        @self.center.reduce(s, [target])
-        def _(prev, new_s, target):
+        # we zoom into the right place. Each scroll changes s by sc.y, which
+        # stays right when several scrolls arrive in one tick.
+        @self.center.reduce(ctx[ScrollChange], [target])
+        def _(prev, sc, target):
             target_to_center = prev - target
-            return target + target_to_center * scroll_factor ** (s() - new_s)
+            return target + target_to_center * scroll_factor ** -sc.y
 
-def draw_shader_image(ctx, fragment_src, *, uniforms={}):
-    _program = pyglet.graphics.shader.ShaderProgram(
-        pyglet.graphics.shader.Shader("#version 330\nin vec2 pos; void main() { gl_Position = vec4(pos, 0.0, 1.0); }", 'vertex'),
-        pyglet.graphics.shader.Shader(fragment_src, 'fragment'),
-    )
+def _shader_image(fragment_src):
+    # Vertex arrays can't be shared between contexts, so each context keeps
+    # its own fragment source -> [program, quad, the draw which last set its
+    # uniforms], which goes when it does.
+    context = pyglet.gl.current_context
+    images = getattr(context, 'refs_shader_images', None)
+    if images is None:
+        images = context.refs_shader_images = {}
+    shared = images.get(fragment_src)
+    if shared is None:
+        program = load_program(
+            vertex="#version 330\nin vec2 pos; void main() { gl_Position = vec4(pos, 0.0, 1.0); }",
+            fragment=fragment_src,
+        )
+        quad = program.vertex_list_indexed(4, pyglet.gl.GL_TRIANGLES,
+            (0, 1, 2, 0, 2, 3),
+            pos=('f', (-1.0,1.0, -1.0,-1.0, 1.0,-1.0, 1.0,1.0)))
+        shared = images[fragment_src] = [program, quad, None]
+    return shared
+
+def _scaled_frag_coord(fragment_src):
+    # Have gl_FragCoord scaled by a uniform, so a smaller framebuffer can
+    # render the same image at lower resolution.
+    version, newline, rest = fragment_src.partition('\n')
+    return (version + newline
+        + "uniform float refs_scale = 1.0;\n"
+        + "vec4 refs_frag_coord() { return vec4(gl_FragCoord.xy * refs_scale, gl_FragCoord.zw); }\n"
+        + rest.replace('gl_FragCoord', 'refs_frag_coord()'))
+
+def draw_shader_image(ctx, fragment_src, *, uniforms={}, progressive=False, preview_scale=4, tile_size=256, budget=0.008):
+    """Draw a fragment shader over the viewport.
+
+    If progressive, the image is rendered into a texture which is redrawn
+    from while the uniforms don't change. After they do, it's re-rendered in
+    tiles of tile_size pixels, as many per frame as take budget seconds (at
+    least one). progressive can also be a collection of uniform names: while
+    those change, a preview at 1/preview_scale resolution is drawn first, and
+    the tiles start again. True means all of them. Changes to other uniforms
+    (e.g. a time which always changes) are held back until the current pass
+    of tiles is finished, so each pass renders one consistent image.
+    """
+    if progressive:
+        fragment_src = _scaled_frag_coord(fragment_src)
+    # Calls with the same source share a program, whose uniforms hold the
+    # values from whichever drew with it last.
+    shared = _shader_image(fragment_src)
+    _program, _vlist = shared[0], shared[1]
+    # Uniforms in blocks are written into a buffer per call, uploaded at most
+    # once a frame.
+    ubos = []
+    block_ubos = {}
+    for block in _program.uniform_blocks.values():
+        ubo = block.create_ubo()
+        ubos.append(ubo)
+        for member, *_ in block.uniforms.values():
+            block_ubos[member.rpartition('.')[2]] = ubo
     uniform_refs = []
+    constants = []
     for name, value in uniforms.items():
-        if name not in _program.uniforms: continue
+        ubo = block_ubos.get(name)
+        if ubo is None and name not in _program.uniforms: continue
         if isinstance(value, Reactive):
-            uniform_refs.append((name, value, Flag(value)))
-            _program[name] = value()
+            uniform_refs.append((name, value, Flag(value), ubo))
         else:
-            print(name, value)
+            constants.append((name, value, ubo))
+    def set_uniform(name, value, ubo):
+        if ubo is None:
             _program[name] = value
-    _vlist = _program.vertex_list_indexed(4, pyglet.gl.GL_TRIANGLES,
-        (0, 1, 2, 0, 2, 3),
-        pos=('f', (-1.0,1.0, -1.0,-1.0, 1.0,-1.0, 1.0,1.0)))
-    def draw():
+        elif isinstance(getattr(ubo.view, name), Array):
+            getattr(ubo.view, name)[:] = value
+        else:
+            setattr(ubo.view, name, value)
+    # name -> value last set.
+    uploaded = {}
+    def use(hold=()):
+        # Bind the program and update its uniforms, except those in hold,
+        # which keep their previous values. Returns the names of the ones
+        # which changed.
         _program.use()
-        for name, value, flag in uniform_refs:
-            if flag.pop():
-                _program[name] = value()
+        reload = shared[2] is not use
+        shared[2] = use
+        changed = []
+        dirty = set(ubos) if reload else set()
+        for name, value, flag, ubo in uniform_refs:
+            if name in hold:
+                if not reload:
+                    continue
+                x = uploaded[name]
+            elif flag.pop():
+                changed.append(name)
+                x = value()
+            elif not reload:
+                continue
+            else:
+                x = value()
+            uploaded[name] = x
+            set_uniform(name, x, ubo)
+            if ubo is not None:
+                dirty.add(ubo)
+        if reload:
+            for name, value, ubo in constants:
+                set_uniform(name, value, ubo)
+        for ubo in ubos:
+            if ubo in dirty:
+                # Uploads the whole buffer, and binds it.
+                with ubo:
+                    pass
+            else:
+                # Blocks with the same name in other programs share the
+                # binding point, so it must be rebound every time.
+                ubo.bind()
+        return changed
+    if not progressive:
+        def draw():
+            use()
+            _vlist.draw(pyglet.gl.GL_TRIANGLES)
+        ctx[Draws].add(ctx[Active], draw)
+        return
+    from time import perf_counter
+    from pyglet.gl import (glBindFramebuffer, glBlitFramebuffer, glDisable, glEnable, glFinish,
+        glGetIntegerv, glScissor, glViewport, GLint, GL_COLOR_BUFFER_BIT, GL_DRAW_FRAMEBUFFER,
+        GL_DRAW_FRAMEBUFFER_BINDING, GL_FRAMEBUFFER, GL_LINEAR, GL_NEAREST, GL_READ_FRAMEBUFFER,
+        GL_SCISSOR_TEST, GL_VIEWPORT)
+    preview_names = set(uniforms) if progressive is True else set(progressive)
+    held_names = set(uniforms) - preview_names
+    has_scale = 'refs_scale' in _program.uniforms
+    # The full-size image and the preview, as (size, framebuffer, texture).
+    image = preview = None
+    # Regions of image still to render, last first.
+    tiles = []
+    def target(size):
+        texture = pyglet.image.Texture.create(*size)
+        framebuffer = pyglet.image.buffer.Framebuffer()
+        framebuffer.attach_texture(texture)
+        return size, framebuffer, texture
+    def render(framebuffer, width, height, scale):
+        glBindFramebuffer(GL_FRAMEBUFFER, framebuffer.id)
+        glViewport(0, 0, width, height)
+        if has_scale:
+            _program['refs_scale'] = scale
         _vlist.draw(pyglet.gl.GL_TRIANGLES)
-    ctx[Draws].add(ctx[Active], draw)
-
-def record_image(ctx, image):
-    take = datetime.now().strftime("refs_gl_%Y-%m-%d_%H-%M-%S")
-    dir = Path(take)
-    dir.mkdir()
-    frames = 0
+    def blit(source, size, dest, x, y, width, height, filter):
+        glBindFramebuffer(GL_READ_FRAMEBUFFER, source)
+        glBindFramebuffer(GL_DRAW_FRAMEBUFFER, dest)
+        glBlitFramebuffer(0, 0, *size, x, y, x + width, y + height, GL_COLOR_BUFFER_BIT, filter)
     def draw():
-        nonlocal frames
-        file = dir / f"{frames:06}.png"
-        image.save(file)
-        frames += 1
+        nonlocal image, preview, tiles
+        start = perf_counter()
+        viewport = (GLint * 4)()
+        glGetIntegerv(GL_VIEWPORT, viewport)
+        x, y, width, height = viewport
+        drawn = GLint()
+        glGetIntegerv(GL_DRAW_FRAMEBUFFER_BINDING, drawn)
+        # Finish the current pass of tiles with the values it started with,
+        # unless a preview uniform changes.
+        changed = use(held_names if tiles else ())
+        show_preview = not preview_names.isdisjoint(changed)
+        if show_preview and tiles:
+            changed += use()
+        if image is None or image[0] != (width, height):
+            image = target((width, height))
+            preview = target((max(width // preview_scale, 1), max(height // preview_scale, 1)))
+            changed = show_preview = True
+        if show_preview or changed and not tiles:
+            tiles = [(tx, ty) for ty in range(0, height, tile_size) for tx in range(0, width, tile_size)]
+            tiles.reverse()
+        if show_preview:
+            render(preview[1], *preview[0], preview_scale)
+            blit(preview[1].id, preview[0], image[1].id, 0, 0, width, height, GL_LINEAR)
+        if tiles:
+            glEnable(GL_SCISSOR_TEST)
+            while tiles:
+                glScissor(*tiles.pop(), tile_size, tile_size)
+                render(image[1], width, height, 1.0)
+                # Wait for the GPU, to know how long it took.
+                glFinish()
+                if perf_counter() - start > budget: break
+            glDisable(GL_SCISSOR_TEST)
+        blit(image[1].id, image[0], drawn.value, x, y, width, height, GL_NEAREST)
+        glBindFramebuffer(GL_FRAMEBUFFER, drawn.value)
+        glViewport(x, y, width, height)
     ctx[Draws].add(ctx[Active], draw)
 
+class Recorder:
+    """Records frames of an image (usually a framebuffer's texture) without
+    stalling drawing.
+
+    capture() has the GPU copy the image into the next of a ring of pixel
+    buffers, which is only read back once the ring comes round again, by when
+    the copy has finished. Frames are then encoded by a pool of worker threads,
+    either as numbered PNGs in dir, or as raw RGBA (bottom row first) written
+    in order to output, a path or a binary file such as a pipe to ffmpeg. If
+    more than `queue` frames are waiting to be encoded, capture() waits.
+    """
+    def __init__(self, image, *, dir=None, output=None, ring=3, queue=8, workers=None):
+        from concurrent.futures import ThreadPoolExecutor
+        from queue import Queue
+        from pyglet.gl import glBindBuffer, glBufferData, glGenBuffers, GLuint, GL_PIXEL_PACK_BUFFER, GL_STREAM_READ
+        self.image = image
+        self.frames = 0
+        self._size = image.width * image.height * 4
+        self._dir = None
+        self._output = None
+        self._owns_output = False
+        if output is None:
+            self._dir = Path(dir)
+            self._dir.mkdir()
+        else:
+            if isinstance(output, (str, Path)):
+                output = open(output, 'wb')
+                self._owns_output = True
+            self._output = output
+            # Raw frames must be written in order.
+            workers = 1
+        self._executor = ThreadPoolExecutor(workers)
+        # Buffers not being encoded, each big enough for a frame.
+        self._free = Queue()
+        for _ in range(queue):
+            self._free.put(bytearray(self._size))
+        self._pbos = (GLuint * ring)()
+        glGenBuffers(ring, self._pbos)
+        for pbo in self._pbos:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glBufferData(GL_PIXEL_PACK_BUFFER, self._size, None, GL_STREAM_READ)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        # (frame, pbo) captured but not yet read back, oldest first.
+        self._pending = []
+    def capture(self):
+        from pyglet.gl import glBindBuffer, glBindTexture, glGetTexImage, GL_PIXEL_PACK_BUFFER, GL_RGBA, GL_UNSIGNED_BYTE
+        if len(self._pending) == len(self._pbos):
+            self._read_back()
+        pbo = self._pbos[self.frames % len(self._pbos)]
+        texture = self.image.get_texture()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        glBindTexture(texture.target, texture.id)
+        # With a pack buffer bound, this returns straight away.
+        glGetTexImage(texture.target, texture.level, GL_RGBA, GL_UNSIGNED_BYTE, None)
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self._pending.append((self.frames, pbo))
+        self.frames += 1
+    def _read_back(self):
+        from ctypes import c_ubyte
+        from pyglet.gl import glBindBuffer, glGetBufferSubData, GL_PIXEL_PACK_BUFFER
+        frame, pbo = self._pending.pop(0)
+        # Waits while the workers are behind.
+        buffer = self._free.get()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        glGetBufferSubData(GL_PIXEL_PACK_BUFFER, 0, self._size, (c_ubyte * self._size).from_buffer(buffer))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self._executor.submit(self._encode, frame, buffer)
+    def _encode(self, frame, buffer):
+        try:
+            if self._output is None:
+                image = pyglet.image.ImageData(self.image.width, self.image.height, 'RGBA', bytes(buffer))
+                image.save(self._dir / f"{frame:06}.png")
+            else:
+                self._output.write(buffer)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+        finally:
+            self._free.put(buffer)
+    def flush(self):
+        """Send all captured frames to be encoded."""
+        while self._pending:
+            self._read_back()
+    def close(self):
+        """Finish encoding all captured frames and release resources."""
+        from pyglet.gl import glDeleteBuffers
+        self.flush()
+        self._executor.shutdown()
+        if self._owns_output:
+            self._output.close()
+        elif self._output is not None:
+            self._output.flush()
+        glDeleteBuffers(len(self._pbos), self._pbos)
+
+def record_image(ctx, image, **options):
+    """Record image every frame while active. See Recorder for options.
+
+    By default, frames are saved as PNGs in a new timestamped directory.
+    """
+    if options.get('output') is None:
+        options['dir'] = datetime.now().strftime("refs_gl_%Y-%m-%d_%H-%M-%S")
+    recorder = Recorder(image, **options)
+    ctx[Draws].add(ctx[Active], recorder.capture)
+    # Don't leave the last few frames in the ring when recording stops.
+    ctx[Draws].add(computed([ctx[Active]])(lambda active: not active), recorder.flush)
+    return recorder
+
 def video_time(ctx, *, fps):
     return computed([ctx[FrameCount]])(lambda fc: fc / fps)
 
@@ -121,12 +377,72 @@ def on_event(active, ctx, name, handler):
         _handler_sets[name].remove(handler)
 
 class Gatherer:
+    """Collects values which are each included while their `on` is true.
+
+    get() returns the included values in the order they were added. It's
+    maintained incrementally: only entries whose `on` changed since the last
+    get() are looked at, so it's cheap however many entries are inactive.
+    """
     def __init__(self):
-        self._all = []
+        self._count = 0
+        # on -> [[index, x], ...]
+        self._by_on = {}
+        self._watchers = {}
+        self._changed = set()
+        # index -> x for the entries whose on is true.
+        self._active = {}
+        self._list = []
     def add(self, on, x):
-        self._all.append([on, x])
+        entries = self._by_on.get(on)
+        if entries is None:
+            entries = self._by_on[on] = []
+            self._watchers[on] = _GathererWatcher(self, on)
+        entries.append([self._count, x])
+        if on():
+            self._active[self._count] = x
+            self._list = None
+        self._count += 1
+    def remove(self, on, x):
+        entries = self._by_on[on]
+        for i, (index, y) in enumerate(entries):
+            if y is x: break
+        else:
+            raise ValueError(f"{x!r} is not in the gatherer")
+        del entries[i]
+        if index in self._active:
+            del self._active[index]
+            self._list = None
+        if not entries:
+            del self._by_on[on]
+            on.unlink(self._watchers.pop(on))
+            self._changed.discard(on)
     def get(self):
-        return [x for on, x in self._all if on()]
+        """Return the list of included values. Don't modify it."""
+        for on in self._changed:
+            value = on()
+            for index, x in self._by_on[on]:
+                if value:
+                    self._active[index] = x
+                else:
+                    self._active.pop(index, None)
+            self._list = None
+        self._changed.clear()
+        if self._list is None:
+            self._list = [self._active[i] for i in sorted(self._active)]
+        return self._list
+
+class _GathererWatcher(Reactive):
+    # Tells a Gatherer when an on reactive updates.
+    __slots__ = ('_gatherer', '_on')
+    def __init__(self, gatherer, on):
+        self._gatherer = gatherer
+        self._on = on
+        Reactive.setup(self, on)
+        self._value = self.next_value = None
+        self.is_event = False
+        on.link(self)
+    def update(self):
+        self._gatherer._changed.add(self._on)
 
 class GLState:
     def __init__(self):
@@ -148,84 +464,118 @@ class Region:
     def __init__(self, size):
         self.size = size
 
-def define_window(setup, width=800, height=600):
-    window = pyglet.window.Window(width=width, height=height)
+def define_window(setup, width=800, height=600, *, deferred=True, frames=None, fps=60):
+    """Open a window and call setup with its Context. Returns what setup
+    returns.
+
+    If deferred is true, input events only set their refs and everything
+    propagates in one tick per frame, in on_draw. Otherwise each event ticks
+    immediately.
+
+    If frames is given, render offline instead: draw that many frames as fast
+    as possible in a hidden window without vsync, with FrameTime going up by
+    1/fps each frame, then close the window. If what setup returns has a
+    close() method (e.g. a Recorder), it's called first, while the GL context
+    still exists. (Set pyglet.options['headless'] before importing pyglet.gl to
+    need no display at all.)
+    """
+    offline = frames is not None
+    window = pyglet.window.Window(width=width, height=height, visible=not offline, vsync=not offline)
     # Load empty handler frame for on_event.
     window._event_stack = [{}]
-    frames = 0
-    v_FrameCount = Ref(0)
-    start_time = time()
-    v_FrameTime = Ref(0.0)
-    v_MousePosition = Ref(None)
-    v_MousePositionChange = Ref(Vec2(0, 0))
-    v_ScrollChange = Ref(Vec2(0, 0), is_event=True)
-    v_LeftMouse = Ref(False)
-    v_MouseDrag = Ref(None, is_event=True)
-    # v_MouseDrag.log = 'md'
-    v_KeyMap = defaultdict(lambda: Ref(False))
-    v_KeyPress = Ref(None, is_event=True)
-    v_Draws = Gatherer()
-    v_Region = Region(Ref(Vec2(width, height)))
-    ctx = Context.initial().add({
-        type(window): window,
-        FrameCount: v_FrameCount,
-        FrameTime: v_FrameTime,
-        MousePosition: v_MousePosition,
-        MousePositionChange: v_MousePositionChange,
-        ScrollChange: v_ScrollChange,
-        LeftMouse: v_LeftMouse,
-        MouseDrag: v_MouseDrag,
-        KeyMap: v_KeyMap,
-        KeyPress: v_KeyPress,
-        Draws: v_Draws,
-        Region: v_Region,
-    })
-    @window.event
-    def on_draw():
-        nonlocal frames
-        v_FrameCount.set(frames)
-        frames += 1
-        v_FrameTime.set(time() - start_time)
-        tick()
-        for f in v_Draws.get(): f()
-    @window.event
-    def on_mouse_motion(x, y, dx, dy):
-        v_MousePosition.set(Vec2(x, y))
-        v_MousePositionChange.set(Vec2(dx, dy))
-        tick()
-    @window.event
-    def on_mouse_drag(x, y, dx, dy, *_):
-        v_MousePosition.set(Vec2(x, y))
-        v_MousePositionChange.set(Vec2(dx, dy))
-        if v_LeftMouse():
-            v_MouseDrag.set(Vec2(dx, dy))
-        tick()
-    @window.event
-    def on_mouse_scroll(x, y, sx, sy):
-        v_ScrollChange.set(Vec2(sx, sy))
-        tick()
-    @window.event
-    def on_mouse_press(x, y, button, modifiers):
-        if button == pyglet.window.mouse.LEFT:
-            v_LeftMouse.set(True)
-            tick()
-    @window.event
-    def on_mouse_release(x, y, button, modifiers):
-        if button == pyglet.window.mouse.LEFT:
-            v_LeftMouse.set(False)
-            tick()
-    @window.event
-    def on_key_press(symbol, modifiers):
-        str_symbol = pyglet.window.key.symbol_string(symbol)
-        v_KeyMap[str_symbol].set(True)
-        v_KeyPress.set(str_symbol)
-        tick()
-    @window.event
-    def on_key_release(symbol, modifiers):
-        v_KeyMap[pyglet.window.key.symbol_string(symbol)].set(False)
-        tick()
-    @window.event
-    def on_resize(w, h):
-        v_Region.size.set(Vec2(w, h))
-        tick()
-    setup(ctx)
+    # Each window has its own graph, ticked by its own events. Cutting off
+    # unchanged values stops e.g. uniforms re-uploading on every mouse move,
+    # and lazy Computeds cost nothing unless something draws with them.
+    runtime = Runtime(equal=equal, lazy=True)
+    with runtime.activate():
+        frame = 0
+        v_FrameCount = Ref(0)
+        start_time = time()
+        v_FrameTime = Ref(0.0)
+        v_MousePosition = Ref(None)
+        v_MousePositionChange = Ref(Vec2(0, 0))
+        v_ScrollChange = Ref(Vec2(0, 0), is_event=True)
+        v_LeftMouse = Ref(False)
+        v_MouseDrag = Ref(None, is_event=True)
+        # v_MouseDrag.log = 'md'
+        def new_key():
+            # Keys may be first looked up from an event handler.
+            with runtime.activate():
+                return Ref(False)
+        v_KeyMap = defaultdict(new_key)
+        v_KeyPress = Ref(None, is_event=True)
+        v_Draws = Gatherer()
+        v_Region = Region(Ref(Vec2(width, height)))
+        ctx = Context.initial().add({
+            type(window): window,
+            FrameCount: v_FrameCount,
+            FrameTime: v_FrameTime,
+            MousePosition: v_MousePosition,
+            MousePositionChange: v_MousePositionChange,
+            ScrollChange: v_ScrollChange,
+            LeftMouse: v_LeftMouse,
+            MouseDrag: v_MouseDrag,
+            KeyMap: v_KeyMap,
+            KeyPress: v_KeyPress,
+            Draws: v_Draws,
+            Region: v_Region,
+        })
+        @window.event
+        def on_draw():
+            nonlocal frame
+            v_FrameCount.set(frame)
+            v_FrameTime.set(frame / fps if offline else time() - start_time)
+            frame += 1
+            runtime.tick()
+            for f in v_Draws.get(): f()
+        input_tick = (lambda: None) if deferred else runtime.tick
+        @window.event
+        def on_mouse_motion(x, y, dx, dy):
+            v_MousePosition.set(Vec2(x, y))
+            v_MousePositionChange.set(Vec2(dx, dy))
+            input_tick()
+        @window.event
+        def on_mouse_drag(x, y, dx, dy, *_):
+            v_MousePosition.set(Vec2(x, y))
+            v_MousePositionChange.set(Vec2(dx, dy))
+            # Use next_value since a press may not have been ticked yet.
+            if v_LeftMouse.next_value:
+                v_MouseDrag.set(Vec2(dx, dy))
+            input_tick()
+        @window.event
+        def on_mouse_scroll(x, y, sx, sy):
+            v_ScrollChange.set(Vec2(sx, sy))
+            input_tick()
+        @window.event
+        def on_mouse_press(x, y, button, modifiers):
+            if button == pyglet.window.mouse.LEFT:
+                v_LeftMouse.set(True)
+                input_tick()
+        @window.event
+        def on_mouse_release(x, y, button, modifiers):
+            if button == pyglet.window.mouse.LEFT:
+                v_LeftMouse.set(False)
+                input_tick()
+        @window.event
+        def on_key_press(symbol, modifiers):
+            str_symbol = pyglet.window.key.symbol_string(symbol)
+            v_KeyMap[str_symbol].set(True)
+            v_KeyPress.set(str_symbol)
+            input_tick()
+        @window.event
+        def on_key_release(symbol, modifiers):
+            v_KeyMap[pyglet.window.key.symbol_string(symbol)].set(False)
+            input_tick()
+        @window.event
+        def on_resize(w, h):
+            v_Region.size.set(Vec2(w, h))
+            input_tick()
+        result = setup(ctx)
+    if offline:
+        window.switch_to()
+        for _ in range(frames):
+            on_draw()
+        if hasattr(result, 'close'):
+            result.close()
+        window.close()
+    return result
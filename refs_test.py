@@ -1,4 +1,298 @@
-from refs import Ref, Computed
+import json
+from concurrent.futures import ThreadPoolExecutor
 
-x = Ref(1)
-xx = Computed(lambda: 2*x())
+import numpy
+import pytest
+
+from refs import (ArrayRef, capture_origins, label, Ref, Computed, ParallelComputed, Reducer, Runtime, Flag, array_computed, auto_computed,
+    computed, equal, euler, fixed_step, gate, rk4, semi_implicit_euler, Profiler)
+
+def test_chain():
+    with Runtime().activate() as runtime:
+        x = Ref(1)
+        xx = Computed(lambda x: 2*x, [x])
+        xxx = computed([xx])(lambda xx: xx + 1)
+    assert xxx() == 3
+    x.set(5)
+    runtime.tick()
+    assert (xx(), xxx()) == (10, 11)
+
+def test_diamond():
+    with Runtime().activate() as runtime:
+        x = Ref(1)
+        left = computed([x])(lambda x: x + 1)
+        right = computed([x])(lambda x: x * 10)
+        both = computed([left, right])(lambda l, r: (l, r))
+        flag = Flag(both)
+    x.set(2)
+    runtime.tick()
+    assert flag.pop()
+    assert both() == (3, 20)
+
+def test_gate():
+    with Runtime().activate() as runtime:
+        open = Ref(True)
+        x = Ref(1)
+        g = gate(open, x)
+    x.set(2)
+    runtime.tick()
+    assert g() == 2
+    open.set(False)
+    runtime.tick()
+    x.set(3)
+    runtime.tick()
+    assert g() == 2
+    open.set(True)
+    runtime.tick()
+    assert g() == 3
+
+def test_reducer_batches_events():
+    with Runtime().activate() as runtime:
+        a = Ref(None, is_event=True)
+        b = Ref(None, is_event=True)
+        log = Reducer(())
+        @log.reduce(a)
+        def _(s, e): return s + (('a', e),)
+        @log.reduce(b)
+        def _(s, e): return s + (('b', e),)
+    with runtime.batch():
+        a.set(1)
+        b.set(2)
+        a.set(3)
+    # In the order the processors were added, each over its events in order.
+    assert log() == (('a', 1), ('a', 3), ('b', 2))
+    assert log.next_events == ()
+
+def test_cutoff():
+    with Runtime(equal=equal).activate() as runtime:
+        x = Ref(1)
+        sign = computed([x])(lambda x: x > 0)
+        after = computed([sign])(lambda sign: not sign)
+        sign_flag = Flag(sign)
+        after_flag = Flag(after)
+    x.set(2)
+    runtime.tick()
+    assert not sign_flag.pop() and not after_flag.pop()
+    x.set(-1)
+    runtime.tick()
+    assert sign_flag.pop() and after_flag.pop()
+    assert after()
+
+def test_lazy_recomputes_only_when_read_and_changed():
+    calls = []
+    with Runtime(lazy=True).activate() as runtime:
+        x = Ref(1)
+        y = computed([x])(lambda x: calls.append(x) or x * 2)
+    assert y() == 2 and y() == 2
+    assert calls == [1]
+    runtime.tick()
+    assert y() == 2
+    assert calls == [1]
+    x.set(3)
+    x.set(4)
+    runtime.tick()
+    assert calls == [1]
+    assert y() == 8
+    assert calls == [1, 4]
+
+def test_auto_computed_relinks():
+    with Runtime().activate() as runtime:
+        use_a = Ref(True)
+        a = Ref(1)
+        b = Ref(2)
+        out = auto_computed(lambda: a() if use_a() else b())
+    assert out() == 1
+    b.set(20)
+    runtime.tick()
+    assert out() == 1
+    use_a.set(False)
+    runtime.tick()
+    assert out() == 20
+    assert out not in a.links
+    b.set(30)
+    runtime.tick()
+    assert out() == 30
+
+def check_positive(x):
+    if x < 0:
+        raise ValueError(x)
+    return x
+
+def failing_parallel(**options):
+    # A ParallelComputed which fails when x is negative, and an unrelated ref.
+    runtime = Runtime(executor=ThreadPoolExecutor(2), **options)
+    with runtime.activate():
+        x = Ref(1)
+        p = ParallelComputed(check_positive, [x])
+        y = Ref(0)
+    return runtime, x, p, y
+
+def test_parallel_computed():
+    runtime, x, p, y = failing_parallel()
+    Flag(p)
+    x.set(2)
+    runtime.tick()
+    assert p() == 2
+
+def test_parallel_failure_finishes_tick():
+    runtime, x, p, y = failing_parallel()
+    Flag(p)
+    x.set(-1)
+    y.set(5)
+    with pytest.raises(ValueError):
+        runtime.tick()
+    assert y() == 5
+    assert not runtime._to_update
+    x.set(3)
+    runtime.tick()
+    assert p() == 3
+
+def test_parallel_failure_with_cutoff():
+    runtime, x, p, y = failing_parallel(equal=equal)
+    Flag(p)
+    assert p() == 1
+    x.set(-1)
+    y.set(5)
+    with pytest.raises(ValueError):
+        runtime.tick()
+    assert y() == 5
+
+def test_parallel_failure_read_by_reducer():
+    runtime, x, p, y = failing_parallel()
+    with runtime.activate():
+        e = Ref(None, is_event=True)
+        seen = Reducer(None)
+        @seen.reduce(e, [p])
+        def _(s, e, p): return p
+    assert p() == 1
+    x.set(-1)
+    y.set(5)
+    e.set(True)
+    with pytest.raises(ValueError):
+        runtime.tick()
+    # The current value stands in for the failed one.
+    assert seen() == 1
+    assert y() == 5
+
+def test_derived_reactives_join_their_deps_runtime():
+    runtime = Runtime()
+    with runtime.activate():
+        x = Ref(1)
+    # Made outside the runtime, e.g. in an event handler.
+    doubled = computed([x])(lambda x: 2*x)
+    g = gate(x, doubled)
+    assert doubled._runtime is g._runtime is runtime
+    x.set(2)
+    runtime.tick()
+    assert g() == 4
+
+def test_array_ref_writes_in_place():
+    with Runtime().activate() as runtime:
+        a = ArrayRef(numpy.zeros((3, 2)))
+    a.write(1)[:] = 5
+    a.write((slice(None), 0))[:] += 1
+    with pytest.raises(IndexError):
+        a.write((2, 1))
+    with pytest.raises(IndexError):
+        a.write([0, 2])
+    runtime.tick()
+    assert a().tolist() == [[1, 0], [6, 5], [1, 0]]
+    assert a.dirty == [slice(1, 2), (slice(None), 0)]
+    # The next value starts off as the current one.
+    a.write(0)[:] += 1
+    runtime.tick()
+    assert a().tolist() == [[2, 1], [6, 5], [1, 0]]
+    runtime.tick()
+    assert a.dirty == []
+
+def test_array_computed():
+    with Runtime(equal=equal).activate() as runtime:
+        a = ArrayRef([1, 1, 1])
+        b = Ref(0)
+        doubled = array_computed([a], 3)(lambda a, out: numpy.multiply(a, 2, out=out))
+        both = computed([doubled, b])(lambda d, b: (d + b).tolist())
+        Flag(both)
+    a.set([3, 3, 3])
+    runtime.tick()
+    assert doubled.dirty == [slice(None)]
+    assert both() == [6, 6, 6]
+    # Its next value stays current in ticks it doesn't update in.
+    b.set(10)
+    runtime.tick()
+    assert doubled.dirty == []
+    assert both() == [16, 16, 16]
+
+def count_step(n, t, dt):
+    return n + 1
+
+def stepped(step, state, times, *, dt=0.01, max_steps=100, **options):
+    # The state after time goes through times, one tick each.
+    with Runtime().activate() as runtime:
+        time = Ref(0.0)
+        r = fixed_step(step, time, state, dt=dt, max_steps=max_steps, **options)
+        Flag(r)
+    for t in times:
+        time.set(t)
+        runtime.tick()
+    return r()
+
+def test_fixed_step_is_frame_rate_independent():
+    for step in (euler(lambda x, t: -x), rk4(lambda x, t: -x)):
+        once = stepped(step, 1.0, [0.1])
+        often = stepped(step, 1.0, [i / 100 for i in range(1, 11)])
+        assert once == pytest.approx(often) and once < 1.0
+    assert stepped(count_step, 0, [0.1]) == stepped(count_step, 0, [i / 100 for i in range(1, 11)]) == 10
+
+def test_fixed_step_caps_steps():
+    # The rest of a long frame is dropped, not caught up on later.
+    assert stepped(count_step, 0, [1.0, 1.01], max_steps=8) == 9
+
+def test_fixed_step_ignores_time_going_backwards():
+    assert stepped(count_step, 0, [0.1, 0.05, 0.15]) == 20
+
+def test_semi_implicit_euler():
+    # A spring, x'' = -x, keeps roughly its energy.
+    x, v = stepped(semi_implicit_euler(lambda x, v, t: -x), (1.0, 0.0), [i / 10 for i in range(1, 101)])
+    assert x*x + v*v == pytest.approx(1.0, abs=0.01)
+
+def test_profiler(tmp_path):
+    profiler = Profiler(trace=True)
+    with Runtime(profiler=profiler, equal=equal).activate() as runtime:
+        x = Ref(1)
+        x.log = 'x'
+        sign = computed([x])(lambda x: x > 0)
+        Flag(sign)
+    x.set(2)
+    runtime.tick()
+    x.set(-1)
+    runtime.tick()
+    # Each tick visited both; the first cut off at sign.
+    assert [(visited, changed) for _, _, visited, changed in profiler.ticks] == [(2, 1), (2, 2)]
+    assert profiler.reactives[x][0] == 2
+    assert "2 ticks" in profiler.report()
+    profiler.chrome_trace(tmp_path / 'trace.json')
+    names = [e['name'] for e in json.loads((tmp_path / 'trace.json').read_text())['traceEvents']]
+    assert names.count('tick') == 2 and names.count('x') == 2
+
+class Doubled(Computed):
+    __slots__ = ()
+    def __init__(self, r):
+        Computed.__init__(self, lambda x: 2*x, [r])
+
+class Holder:
+    def __init__(self, r):
+        self.doubled = Doubled(r)
+
+def test_origins():
+    x = Ref(1)
+    assert label(x).startswith("Ref 0x")
+    x.set_origin()
+    assert label(x).startswith("Ref at test_origins:")
+    capture_origins()
+    try:
+        # Reactives' own initialisers are skipped, but not other classes'.
+        assert label(Doubled(x)).startswith("Doubled at test_origins:")
+        assert label(Holder(x).doubled).startswith("Doubled at __init__:")
+    finally:
+        capture_origins(False)
+    assert Doubled(x)._origin is None
@@ -0,0 +1,185 @@
+"""On-disk cache of linked shader program binaries.
+
+load_program(vertex=..., fragment=...) returns a pyglet ShaderProgram. The
+first time a set of sources is seen with a given driver, it's compiled from
+source and its binary saved (if the driver supports glGetProgramBinary);
+after that, in any process, it's loaded from the binary instead. Time it:
+
+    python shader_cache.py shaders/mandelbrot.glsl
+    python shader_cache.py shaders/mandelbrot.glsl --headless
+"""
+import hashlib
+import os
+import sys
+from ctypes import byref, c_buffer, c_char_p, c_int, cast, create_string_buffer
+from pathlib import Path
+from time import perf_counter
+
+import pyglet
+if __name__ == '__main__' and '--headless' in sys.argv:
+    # Must be set before pyglet.gl is imported.
+    pyglet.options['headless'] = True
+from pyglet.gl import (glAttachShader, glCreateProgram, glDeleteProgram, glDetachShader, glGetIntegerv,
+    glGetProgramBinary, glGetProgramInfoLog, glGetProgramiv, glGetString, glLinkProgram, glProgramBinary,
+    glProgramParameteri, GLenum, GLint, GL_INFO_LOG_LENGTH, GL_LINK_STATUS, GL_NUM_PROGRAM_BINARY_FORMATS,
+    GL_PROGRAM_BINARY_LENGTH, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_RENDERER, GL_TRUE, GL_VENDOR, GL_VERSION)
+from pyglet.gl.lib import GLException
+from pyglet.graphics import shader as _shader
+from pyglet.graphics.shader import Shader, ShaderException, ShaderProgram
+
+directory = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'moonsys' / 'shaders'
+stats = {'hits': 0, 'misses': 0, 'seconds': 0.0}
+
+class CachedProgram(ShaderProgram):
+    """A ShaderProgram made from an already linked program."""
+    __slots__ = ()
+    def __init__(self, program_id):
+        # What ShaderProgram.__init__ does after linking.
+        self._id = program_id
+        self._context = pyglet.gl.current_context
+        have_dsa = pyglet.gl.gl_info.have_version(4, 1) or pyglet.gl.gl_info.have_extension("GL_ARB_separate_shader_objects")
+        self._attributes = _shader._introspect_attributes(program_id)
+        self._uniforms = _shader._introspect_uniforms(program_id, have_dsa)
+        self._uniform_blocks = _shader._introspect_uniform_blocks(self)
+
+def _driver():
+    return b'\n'.join(cast(glGetString(name), c_char_p).value or b'' for name in (GL_VENDOR, GL_RENDERER, GL_VERSION))
+
+def _supported():
+    # Querying the formats is itself an error without program binaries.
+    gl_info = pyglet.gl.gl_info
+    if not (gl_info.have_version(4, 1) or gl_info.have_extension('GL_ARB_get_program_binary')):
+        return False
+    formats = GLint()
+    glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS, formats)
+    return formats.value > 0
+
+def _linked(program_id):
+    status = c_int()
+    glGetProgramiv(program_id, GL_LINK_STATUS, byref(status))
+    return bool(status.value)
+
+def _link(stages, retrievable):
+    shaders = [Shader(src, stage) for stage, src in stages.items()]
+    program_id = glCreateProgram()
+    if retrievable:
+        glProgramParameteri(program_id, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
+    for shader in shaders:
+        glAttachShader(program_id, shader.id)
+    glLinkProgram(program_id)
+    if not _linked(program_id):
+        length = c_int()
+        glGetProgramiv(program_id, GL_INFO_LOG_LENGTH, length)
+        log = c_buffer(length.value)
+        glGetProgramInfoLog(program_id, len(log), None, log)
+        glDeleteProgram(program_id)
+        raise ShaderException(f"Error linking shader program:\n{log.value.decode()}")
+    for shader in shaders:
+        glDetachShader(program_id, shader.id)
+        shader.delete()
+    return program_id
+
+def _load(path):
+    # The binary's format, as 4 bytes, then the binary.
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return None
+    if len(data) < 4:
+        _discard(path)
+        return None
+    program_id = glCreateProgram()
+    try:
+        glProgramBinary(program_id, int.from_bytes(data[:4], 'little'), data[4:], len(data) - 4)
+        linked = _linked(program_id)
+    except GLException:
+        # E.g. the driver no longer lists the format.
+        linked = False
+    if not linked:
+        # E.g. the driver was updated without changing its version string.
+        glDeleteProgram(program_id)
+        _discard(path)
+        return None
+    return program_id
+
+def _discard(path):
+    try:
+        path.unlink()
+    except OSError:
+        pass
+
+def _save(path, program_id):
+    length = GLint()
+    glGetProgramiv(program_id, GL_PROGRAM_BINARY_LENGTH, length)
+    if not length.value:
+        return
+    binary = create_string_buffer(length.value)
+    binary_format = GLenum()
+    glGetProgramBinary(program_id, length.value, None, binary_format, binary)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Write then rename so other processes never read half a file.
+    temp = path.with_name(f"{path.name}.{os.getpid()}")
+    temp.write_bytes(binary_format.value.to_bytes(4, 'little') + binary.raw)
+    os.replace(temp, path)
+
+def load_program(**stages):
+    """Return a ShaderProgram of the given stage sources, e.g. vertex=...,
+    fragment=..., from the cache if possible."""
+    start = perf_counter()
+    program_id = None
+    path = None
+    if _supported():
+        key = hashlib.blake2b(_driver(), digest_size=16)
+        for stage, src in sorted(stages.items()):
+            key.update(b'\0' + stage.encode() + b'\0' + src.encode())
+        path = directory / f"{key.hexdigest()}.bin"
+        program_id = _load(path)
+    if program_id is None:
+        stats['misses'] += 1
+        program_id = _link(stages, path is not None)
+        if path is not None:
+            try:
+                _save(path, program_id)
+            except OSError:
+                pass
+    else:
+        stats['hits'] += 1
+    program = CachedProgram(program_id)
+    stats['seconds'] += perf_counter() - start
+    return program
+
+def main():
+    import argparse
+    import tempfile
+    global directory
+    parser = argparse.ArgumentParser(description="Time loading fragment shaders cold and from the cache.")
+    parser.add_argument('shaders', nargs='+', metavar='fragment_shader')
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    parser.add_argument('--headless', action='store_true', help="use pyglet's headless mode")
+    args = parser.parse_args()
+    window = pyglet.window.Window(visible=False)
+    print(f"binary cache {'supported' if _supported() else 'unsupported'} by {_driver().decode().splitlines()[1]}")
+    vertex_src = "#version 330\nin vec2 pos; void main() { gl_Position = vec4(pos, 0.0, 1.0); }"
+    print(f"{'shader':<32}{'source ms':>12}{'cached ms':>12}")
+    with tempfile.TemporaryDirectory() as temp:
+        directory = Path(temp)
+        for file in args.shaders:
+            fragment_src = Path(file).read_text()
+            cold = warm = float('inf')
+            for i in range(args.repeats):
+                # Make each source unique, so the driver's own cache doesn't
+                # help the cold case.
+                src = f"{fragment_src}\n// {os.getpid()} {i}\n"
+                for attempt in range(2):
+                    start = perf_counter()
+                    load_program(vertex=vertex_src, fragment=src).delete()
+                    elapsed = perf_counter() - start
+                    if attempt == 0:
+                        cold = min(cold, elapsed)
+                    else:
+                        warm = min(warm, elapsed)
+            print(f"{file:<32}{cold * 1e3:>12.2f}{warm * 1e3:>12.2f}")
+    window.close()
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 #version 330
-uniform vec2 resolution;
-uniform vec2 offset;
-uniform float time;
-uniform float zoom;
+layout(std140) uniform Params {
+    vec2 resolution;
+    vec2 offset;
+    float time;
+    float zoom;
+};
 const int maxIterations = 200;
 const float escapeRadius = 100.0;
 vec3 oklab_mix( vec3 colA, vec3 colB, float h )